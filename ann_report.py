@@ -0,0 +1,114 @@
+import argparse
+import json
+import time
+import numpy as np
+import faiss
+from doc_anatomy_demo import (indexed_files, load_index, entry_vectors, make_index, describe_index, search_index,
+                              vector_bytes, index_types, storage_precisions)
+
+#Recall-vs-latency report of the ANN index types and storage precisions against the flat float32 baseline.
+#Runs offline on the vectors already stored in indexed_pdfs/, optionally scaled up with
+#synthetic near-duplicates, using perturbed stored vectors as queries. Compact precisions are
+#reported both from the coarse scan alone and with exact re-ranking of the candidates.
+
+def load_vectors(files):
+    #Stored chunk vectors of the given indexed files
+    return np.vstack([entry_vectors(load_index(f)) for f in files]).astype('float32')
+
+def scale_vectors(vectors, size, rng):
+    #Grow the corpus to size vectors by adding noisy copies of the real ones
+    if size <= len(vectors):
+        return vectors
+    extra = vectors[rng.integers(0, len(vectors), size - len(vectors))]
+    extra = extra + rng.normal(0, 0.05, extra.shape).astype('float32') * np.abs(extra).mean()
+    return np.vstack([vectors, extra]).astype('float32')
+
+def recall_at_k(found, truth):
+    #Fraction of the exact top-k neighbours returned by the approximate search
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+def time_search(entry, queries, top_k, nprobe=None, ef_search=None):
+    start = time.perf_counter()
+    for query in queries:
+        search_index(entry, query[None, :], top_k, nprobe, ef_search)
+    latency = (time.perf_counter() - start) / len(queries) * 1000
+    _, found = search_index(entry, queries, top_k, nprobe, ef_search)
+    return latency, found
+
+def run_report(files, size, n_queries, top_k, nprobes, ef_searches, precisions):
+    rng = np.random.default_rng(0)
+    vectors = scale_vectors(load_vectors(files), size, rng)
+    queries = vectors[rng.integers(0, len(vectors), n_queries)]
+    queries = queries + rng.normal(0, 0.05, queries.shape).astype('float32') * np.abs(queries).mean()
+
+    rows = []
+    _, truth = make_index(vectors, "flat", "float32").search(queries, top_k)  # Exact neighbours
+    baseline_bytes = len(vectors) * vectors.shape[1] * 4  # Resident float32 vectors of a flat index
+    for index_type in index_types:
+        for precision in precisions:
+            if (index_type == "ivf_pq" and precision != "float32") or (precision == "binary" and index_type != "flat"):
+                continue  # PQ is already compressed; binary storage is flat only
+            start = time.perf_counter()
+            index = make_index(vectors, index_type, precision)
+            build = time.perf_counter() - start
+            if isinstance(index, faiss.IndexBinary):
+                size_bytes = faiss.serialize_index_binary(index).size
+            else:
+                size_bytes = faiss.serialize_index(index).size
+            resident = index.ntotal * vector_bytes(index)
+            if isinstance(index, faiss.IndexIVF):
+                settings = [('nprobe', n, {'nprobe': n}) for n in nprobes]
+            elif isinstance(index, faiss.IndexHNSW):
+                settings = [('efSearch', ef, {'ef_search': ef}) for ef in ef_searches]
+            else:
+                settings = [('-', '-', {})]
+            rescoring = [False, True] if precision != "float32" else [False]
+            for name, value, params in settings:
+                for rescore in rescoring:
+                    entry = {'index': index, 'vectors': vectors if rescore else None}
+                    latency, found = time_search(entry, queries, top_k, **params)
+                    rows.append({
+                        'index_type': index_type,
+                        'built': describe_index(index),  # Small corpora fall back to flat
+                        'precision': precision,
+                        'rescored': rescore,
+                        'param': name,
+                        'value': value,
+                        'recall': recall_at_k(found, truth),
+                        'latency_ms': latency,
+                        'build_s': build,
+                        'index_bytes': size_bytes,
+                        'resident_bytes': resident,
+                        'memory_saving': 1 - resident / baseline_bytes,
+                        'vectors': len(vectors),
+                        'top_k': top_k,
+                    })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of ANN index types and storage precisions against the flat index")
+    parser.add_argument("--files", nargs="*", help="Indexed file base names (default: all)")
+    parser.add_argument("--size", type=int, default=0, help="Scale the corpus up to this many vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[16, 32, 64, 128])
+    parser.add_argument("--precision", nargs="*", default=storage_precisions, choices=storage_precisions)
+    parser.add_argument("--json", help="Write the rows to this file")
+    args = parser.parse_args()
+
+    rows = run_report(args.files or indexed_files(), args.size, args.queries, args.top_k, args.nprobe, args.ef_search,
+                      args.precision)
+    print(f"{'index':<10}{'built':<10}{'precision':<10}{'rescore':<8}{'param':<10}{'value':>7}{'recall@k':>10}"
+          f"{'ms/query':>10}{'build s':>9}{'size KB':>10}{'RAM KB':>10}{'saved':>7}")
+    for r in rows:
+        print(f"{r['index_type']:<10}{r['built']:<10}{r['precision']:<10}{'yes' if r['rescored'] else '-':<8}{r['param']:<10}"
+              f"{str(r['value']):>7}{r['recall']:>10.3f}{r['latency_ms']:>10.3f}{r['build_s']:>9.2f}"
+              f"{r['index_bytes'] / 1024:>10.0f}{r['resident_bytes'] / 1024:>10.0f}{r['memory_saving']:>7.0%}")
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(rows, indent=2))
+
+if __name__ == "__main__":
+    main()
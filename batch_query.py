@@ -0,0 +1,73 @@
+import argparse
+import json
+import sys
+import time
+from doc_anatomy_demo import get_embedding_model, query_batch, query_corpus_batch
+
+#Run questions from a JSONL file through retrieval in batches and write the hits as JSONL.
+#Example:
+#   python batch_query.py questions.jsonl results.jsonl --file The_Art_Of_War --top-k 5
+#Each input line is a JSON object; the question is read from --field (default "query") and
+#an optional identifier from --id-field. Throughput is reported in queries per second.
+
+def read_batches(path, field, id_field, batch_size):
+    #Yield lists of (id, question) pairs without loading the whole file
+    batch = []
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            question = record.get(field)
+            if not question:
+                print(f"Line {line_no + 1}: no '{field}' field, skipped", file=sys.stderr)
+                continue
+            batch.append((record.get(id_field, line_no), question))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch retrieval over JSONL questions")
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file for the results")
+    parser.add_argument("--file", help="Indexed file base name (default: search all documents)")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--field", default="query", help="Field holding the question")
+    parser.add_argument("--id-field", default="id", help="Field holding the question identifier")
+    parser.add_argument("--with-text", action="store_true", help="Include chunk texts in the output")
+    args = parser.parse_args()
+
+    embedding_model = get_embedding_model()
+    total = 0
+    search_time = 0.0
+    with open(args.output, "w") as out:
+        for batch in read_batches(args.input, args.field, args.id_field, args.batch_size):
+            questions = [question for _, question in batch]
+            start = time.perf_counter()
+            if args.file:
+                results = query_batch(embedding_model, args.file, questions, args.top_k)
+            else:
+                results = query_corpus_batch(embedding_model, questions, args.top_k)
+            search_time += time.perf_counter() - start
+            results = results or [[] for _ in batch]
+            for (qid, question), hits in zip(batch, results):
+                rows = []
+                for hit in hits:
+                    row = {'id': hit['id'], 'page_number': hit['page_number'], 'score': hit['score']}
+                    if 'file' in hit:
+                        row['file'] = hit['file']
+                    if args.with_text:
+                        row['text'] = hit['text']
+                    rows.append(row)
+                out.write(json.dumps({'id': qid, 'query': question, 'results': rows}, ensure_ascii=False) + "\n")
+            total += len(batch)
+
+    qps = total / search_time if search_time > 0 else 0.0
+    print(f"{total} queries in {search_time:.2f}s ({qps:.1f} queries/s)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+import numpy as np
+import doc_anatomy_demo as dad
+
+#End-to-end benchmark of the indexing and query hot paths.
+#   python benchmark.py --out benchmark_results.json
+#   python benchmark.py --hash-embeddings --sizes 1000 10000 100000 --compare old_results.json
+#Stage timings come from the bundled PDF/ files, and query latency and index size also from
+#synthetic corpora scaled up from their chunks. Indexes are written to a temporary folder, so
+#indexed_pdfs/ is not touched. --hash-embeddings swaps the sentence transformer for a
+#deterministic hashing embedder, so the run needs neither the model download nor a GPU.
+
+default_queries = [
+    "What is The Art of War mainly about?",
+    "Why does Sun Tzu say it is important to plan before a battle?",
+    "What is the main question Turing asks in Computing Machinery and Intelligence?",
+    "What is the Turing Test and why is it important?",
+    "How does Turing address objections to machine intelligence?",
+    "What is prompt engineering according to the Google white paper?",
+]
+
+class HashingEmbedder:
+    #Stand-in for SentenceTransformer: feature-hashes words into a fixed-size normalized vector
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else texts
+        out = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                out[row, zlib.crc32(word.encode("utf-8")) % self.dimension] += 1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        out /= np.where(norms > 0, norms, 1.0)
+        return out[0] if single else out
+
+def peak_rss_mb():
+    #Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+def index_bytes(file_base):
+    #On-disk size of every artifact of the committed generation of file_base
+    folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    return sum(os.path.getsize(os.path.join(folder, f)) for generation, f in dad.generation_files(file_base)
+               if generation == dad.current_generation(file_base))
+
+def percentiles(samples):
+    values = np.array(samples) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p95_ms': float(np.percentile(values, 95)),
+            'p99_ms': float(np.percentile(values, 99))}
+
+def query_latency(embedding_model, file_base, queries, top_k, repeats):
+    #Latency of query_faiss_index with the query caches cleared before every call
+    samples = []
+    for _ in range(repeats):
+        for query in queries:
+            dad.query_embedding_cache.purge()
+            dad.result_cache.purge()
+            start = time.perf_counter()
+            dad.query_faiss_index(embedding_model, file_base, query, top_k)
+            samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+def bench_pdf(embedding_model, path, chunk_size, chunk_overlap, queries, top_ks, repeats):
+    #Time each pipeline stage for one PDF
+    file_name = os.path.splitext(os.path.basename(path))[0]
+    row = {'file': file_name, 'stages': {}}
+
+    start = time.perf_counter()
+    documents = dad.llama_simple_reader(path)
+    row['stages']['read'] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+
+    start = time.perf_counter()
+    nodes, record_dict = dad.chunk_documents(file_name, documents, path, chunk_size, chunk_overlap)
+    row['stages']['chunk'] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+
+    dad.embedding_cache.clear()  # Measure real encoding, not the re-indexing cache
+    start = time.perf_counter()
+    embeddings, ids = dad.embed_record_dict(record_dict, embedding_model)
+    elapsed = time.perf_counter() - start
+    row['stages']['embed'] = {'seconds': elapsed, 'peak_rss_mb': peak_rss_mb(),
+                              'chunks_per_sec': len(ids) / elapsed if elapsed > 0 else 0.0}
+
+    start = time.perf_counter()
+    dad.index_embeddings(embeddings, ids, record_dict, file_name)
+    row['stages']['index'] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+
+    dad.invalidate_index()
+    start = time.perf_counter()
+    dad.load_index(file_name)
+    row['stages']['load'] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+
+    row['chunks'] = len(ids)
+    row['index_bytes'] = index_bytes(file_name)
+    row['query'] = {str(k): query_latency(embedding_model, file_name, queries, k, repeats) for k in top_ks}
+    return row, record_dict, embeddings
+
+def bench_synthetic(embedding_model, records, embeddings, size, queries, top_ks, repeats, rng):
+    #Scale the real chunks up to size rows (noisy copies) and measure index build, size and query latency
+    picks = rng.integers(0, len(records), size)
+    vectors = embeddings[picks] + rng.normal(0, 0.01, (size, embeddings.shape[1])).astype('float32')
+    ids = [f"synthetic_{size}_{i}" for i in range(size)]
+    record_dict = {id_: SimpleNamespace(text=records[p].text, metadata=dict(records[p].metadata)) for id_, p in zip(ids, picks)}
+    file_base = f"synthetic_{size}"
+
+    start = time.perf_counter()
+    dad.index_embeddings(vectors, ids, record_dict, file_base)
+    build = time.perf_counter() - start
+    return {
+        'size': size,
+        'index_seconds': build,
+        'index_bytes': index_bytes(file_base),
+        'peak_rss_mb': peak_rss_mb(),
+        'query': {str(k): query_latency(embedding_model, file_base, queries, k, repeats) for k in top_ks},
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(results, baseline_path):
+    #Print relative changes of the headline numbers against an earlier results file
+    with open(baseline_path, "r") as f:
+        baseline = json.loads(f.read())
+    print(f"\nChange vs {baseline_path} ({baseline.get('commit', '?')}):")
+    old_files = {row['file']: row for row in baseline.get('pdfs', [])}
+    for row in results['pdfs']:
+        old = old_files.get(row['file'])
+        if old is None:
+            continue
+        for stage, data in row['stages'].items():
+            before = old['stages'].get(stage, {}).get('seconds')
+            if before:
+                print(f"  {row['file']:<30}{stage:<8}{(data['seconds'] - before) / before * 100:>+8.1f}%")
+    old_sizes = {str(row['size']): row for row in baseline.get('synthetic', [])}
+    for row in results['synthetic']:
+        old = old_sizes.get(str(row['size']))
+        if old is None:
+            continue
+        for k, latency in row['query'].items():
+            before = old['query'].get(k, {}).get('p95_ms')
+            if before:
+                print(f"  synthetic_{row['size']:<20}p95@{k:<4}{(latency['p95_ms'] - before) / before * 100:>+8.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark indexing and query hot paths")
+    parser.add_argument("--pdf-folder", default=dad.PDF)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--top-k", type=int, nargs="*", default=[1, 5, 20])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 10000, 100000], help="Synthetic corpus sizes (chunks)")
+    parser.add_argument("--repeats", type=int, default=5, help="Passes over the query set per measurement")
+    parser.add_argument("--hash-embeddings", action="store_true", help="Use the hashing embedder instead of the model")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    embedding_model = HashingEmbedder() if args.hash_embeddings else dad.get_embedding_model()
+    pdfs = sorted(os.path.join(args.pdf_folder, f) for f in os.listdir(args.pdf_folder) if f.lower().endswith(".pdf"))
+    results = {'commit': git_commit(), 'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+               'embedder': 'hashing' if args.hash_embeddings else dad.embedding_model_name,
+               'chunk_size': args.chunk_size, 'chunk_overlap': args.chunk_overlap, 'pdfs': [], 'synthetic': []}
+
+    cwd = os.getcwd()
+    out_path = os.path.abspath(args.out)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "indexed_pdfs"))
+        os.chdir(workdir)  # Index files are written under the current directory
+        try:
+            records, vectors = [], []
+            for path in pdfs:
+                row, record_dict, embeddings = bench_pdf(embedding_model, path, args.chunk_size, args.chunk_overlap,
+                                                         default_queries, args.top_k, args.repeats)
+                results['pdfs'].append(row)
+                records.extend(record_dict.values())
+                vectors.append(np.asarray(embeddings))
+                stages = "  ".join(f"{name} {data['seconds']:.2f}s" for name, data in row['stages'].items())
+                print(f"{row['file']}: {row['chunks']} chunks  {stages}  "
+                      f"{row['stages']['embed']['chunks_per_sec']:.0f} chunks/s  {row['index_bytes'] / 1024:.0f} KB")
+            if records:
+                all_vectors = np.vstack(vectors)
+                for size in args.sizes:
+                    row = bench_synthetic(embedding_model, records, all_vectors, size, default_queries, args.top_k, args.repeats, rng)
+                    results['synthetic'].append(row)
+                    latency = "  ".join(f"k={k} p50 {q['p50_ms']:.2f} p95 {q['p95_ms']:.2f} p99 {q['p99_ms']:.2f}ms"
+                                        for k, q in row['query'].items())
+                    print(f"synthetic {size}: build {row['index_seconds']:.2f}s  {row['index_bytes'] / 1024 / 1024:.1f} MB  "
+                          f"peak RSS {row['peak_rss_mb']:.0f} MB  {latency}")
+        finally:
+            os.chdir(cwd)
+            dad.invalidate_index()
+
+    with open(out_path, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    print(f"Results written to {out_path}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,22 @@ import pickle
 import numpy as np
 import faiss
 import json
+import csv
+import re
+import signal
+import hashlib
+import threading
+import time
+import queue
+import asyncio
+from collections import OrderedDict, Counter
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from llama_index.core import SimpleDirectoryReader
-from llama_index.core.node_parser import SimpleNodeParser
-from google import genai
 import json_repair
+from tracing import trace_request, span, count, record_error, trace_rows
+#sentence_transformers (torch), llama_index and google.genai are imported where they are first
+#used so the UI can render before they finish loading.
 
 #Initialization of varibales
 global my_key
@@ -18,18 +28,822 @@ PDF = os.path.join(cwd, "PDF")  # List of pdf files
 chunk_file=os.path.join(cwd,"chunk_stats.json")#file containing the chunk and overl size metadata for each file
 
 my_key=""##<--- Add your Gemni API key here **
+embedding_model_name="all-MiniLM-L6-v2"#Sentence transformer used for chunks and queries
+embedding_model_state={'model': None, 'warming': False, 'warm': False}#Process-wide model shared by all sessions
+embedding_model_lock=threading.Lock()
+model_warmup=os.environ.get("MODEL_WARMUP","1")=="1"#Load the model in the background when the app starts
+
+#Resident index cache shared by every query in the process
+index_cache_budget=int(os.environ.get("INDEX_CACHE_MB","512"))*1024*1024#Memory budget (bytes) for cached indexes
+index_cache=OrderedDict()#file_base -> cache entry, least recently used first
+index_cache_lock=threading.Lock()
+
+embed_batch_size=int(os.environ.get("EMBED_BATCH_SIZE","64"))#Chunks encoded per forward pass
+embed_stats={}#Throughput of the most recent embedding run
+
+index_workers=int(os.environ.get("INDEX_WORKERS","0")) or os.cpu_count() or 1#Processes used to extract and chunk files
+extract_timeout=float(os.environ.get("EXTRACT_TIMEOUT","300"))#Seconds one file may spend in extraction and chunking (0 = no limit)
+index_queue_size=int(os.environ.get("INDEX_QUEUE_SIZE","4"))#Chunked files waiting for the embedding worker
+stream_ingest_pages=int(os.environ.get("STREAM_INGEST_PAGES","300"))#PDFs with more pages are ingested page by page
+stream_batch_chunks=int(os.environ.get("STREAM_BATCH_CHUNKS","256"))#Chunks embedded and appended per checkpoint
+
+#Incremental indexing state
+manifest_lock=threading.Lock()
+embedding_cache=OrderedDict()#sha1(text) -> embedding, least recently used first, loaded lazily from disk
+embedding_cache_state={'loaded': False, 'dirty': False}
+embedding_cache_max=int(os.environ.get("EMBED_CACHE_MAX","200000"))#Max cached chunk embeddings
+embedding_cache_lock=threading.Lock()
+migration_lock=threading.Lock()#Serializes in-place rewrites of indexes written by older versions
+
+#Approximate nearest-neighbour settings
+index_types=["flat", "ivf_flat", "ivf_pq", "hnsw"]
+default_index_type=os.environ.get("INDEX_TYPE","flat")#Index built by index_embeddings
+ann_train_sample=int(os.environ.get("ANN_TRAIN_SAMPLE","50000"))#Vectors used to train IVF/PQ quantizers
+ann_nprobe=int(os.environ.get("ANN_NPROBE","8"))#IVF lists visited per query
+ann_ef_search=int(os.environ.get("ANN_EF_SEARCH","64"))#HNSW candidate list size per query
+
+#Vector storage precision. Compact indexes are searched for rescore_factor*top_k candidates, which are
+#re-ranked exactly against float32 vectors kept memory-mapped on disk ({file}__vectors.npy).
+storage_precisions=["float32", "float16", "int8", "binary"]
+default_precision=os.environ.get("INDEX_PRECISION","float32")
+rescore_factor=int(os.environ.get("RESCORE_FACTOR","4"))#Coarse candidates per requested result
+
+#Vectors are L2-normalized at index and query time, so dense scores are cosine similarities in [-1, 1]
+default_min_score=float(os.environ.get("MIN_SCORE","0.2"))#Hits scoring below this are not sent to the LLM
+default_score_margin=float(os.environ.get("SCORE_MARGIN","0"))#Adaptive k: keep hits within this of the best (0 = off)
+
+#Passages sent to the conclusion prompt are de-duplicated, merged and packed into a token budget
+context_token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET","2000"))#Estimated tokens of passage text per prompt
+chars_per_token=4#Rough size of an LLM token in English text
+min_passage_tokens=50#A passage cut shorter than this is dropped instead
+
+#Lexical (BM25) retrieval, fused with the dense ranking in hybrid mode
+retrieval_modes=["dense", "hybrid"]
+default_retrieval_mode=os.environ.get("RETRIEVAL_MODE","dense")
+bm25_k1=float(os.environ.get("BM25_K1","1.2"))#Term frequency saturation
+bm25_b=float(os.environ.get("BM25_B","0.75"))#Chunk length normalization
+rrf_k=int(os.environ.get("RRF_K","60"))#Rank constant of reciprocal rank fusion
+hybrid_depth=int(os.environ.get("HYBRID_DEPTH","50"))#Candidates taken from each ranking before fusion
+bm25_lock=threading.Lock()
+stopwords=frozenset("a an and are as at be but by for from has have he her his i if in into is it its of on or "
+                    "she so that the their them then there these they this to was we were which will with you".split())
+
+#Query-side caches
+query_cache_size=int(os.environ.get("QUERY_CACHE_SIZE","1024"))#Entries per cache layer
+query_cache_ttl=float(os.environ.get("QUERY_CACHE_TTL","3600"))#Seconds before a cached embedding/result expires
+llm_cache_ttl=float(os.environ.get("LLM_CACHE_TTL","3600"))#Seconds before a cached LLM response expires
+semantic_cache_threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD","0.9"))#Query similarity at which a past answer is reused (above 1 = off)
+semantic_cache_size=int(os.environ.get("SEMANTIC_CACHE_SIZE","256"))#Answers kept per document and index version
+
+#LLM settings
+llm_model_name="gemini-2.0-flash"
+llm_base_url=os.environ.get("GEMINI_BASE_URL","")#Point at a local stub server for testing, empty for Google
+llm_concurrency=int(os.environ.get("LLM_CONCURRENCY","8"))#Parallel relevance checks in flight
+llm_timeout=float(os.environ.get("LLM_TIMEOUT","30"))#Seconds per LLM call before retrying
+llm_retries=int(os.environ.get("LLM_RETRIES","2"))#Extra attempts after a failed or timed-out call
+llm_backend=os.environ.get("LLM_BACKEND","gemini")#Streaming backend: gemini, or fake for offline tests
+fake_llm_delay=float(os.environ.get("FAKE_LLM_DELAY","0.02"))#Seconds between tokens of the fake backend
+llm_state={'client': None, 'loop': None}#Shared client and the event loop its async calls run on
+llm_lock=threading.Lock()
+
+#Remote retrieval (retrieval_service.py). When set, the app is a thin client and loads no model or index.
+retrieval_service_url=os.environ.get("RETRIEVAL_SERVICE_URL","")
+retrieval_service_timeout=float(os.environ.get("RETRIEVAL_SERVICE_TIMEOUT","120"))
+service_connections=queue.LifoQueue()#Idle kept-alive connections to the service
+
+#Index generations: every (re)index writes a complete new set of files under the stem {file}__g{N}
+#and commits it by atomically replacing the pointer {file}__current.json. Readers resolve the stem
+#through the pointer, so a query sees either the old or the new generation, never a mix of both.
+#Files without a pointer are generation 0 (unversioned names, as written by older versions).
+index_generations_kept=int(os.environ.get("INDEX_GENERATIONS_KEPT","2"))#Committed generations left on disk for in-flight readers
+
+#Combined index over every indexed document
+corpus_name="__corpus__"
+corpus_cache={}
+corpus_lock=threading.Lock()
+
+class TTLCache:
+    #Thread-safe LRU cache whose entries also expire after ttl seconds. Counts hits and misses.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def purge(self, predicate=None):
+        #Remove every entry, or only those whose key matches predicate
+        with self.lock:
+            if predicate is None:
+                self.items.clear()
+            else:
+                for key in [k for k in self.items if predicate(k)]:
+                    del self.items[key]
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+class SemanticCache:
+    #Final answers of past queries, found again by cosine similarity of the query embedding, so paraphrases
+    #of a question skip retrieval and the LLM. Each scope (searched documents at their index version plus the
+    #answer settings) has a small IndexFlatIP over its query embeddings. A scope keeps its max_size most
+    #recently used answers, answers expire after ttl seconds, and invalidate() drops a document's scopes.
+    max_scopes = 64  # Scopes of old index versions or settings are evicted least recently used first
+
+    def __init__(self, max_size, threshold, ttl):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.scopes = OrderedDict()  # scope -> {'index': IndexIDMap2, 'answers': OrderedDict id -> (expiry, query, answer), 'next': int}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scope, embedding):
+        #(answer, cached query, similarity) of the closest past query above the threshold, else None
+        with self.lock:
+            cache = self.scopes.get(scope)
+            if cache is not None and cache['index'].ntotal:
+                scores, ids = cache['index'].search(embedding.reshape(1, -1).astype('float32'), 1)
+                answer_id, score = int(ids[0][0]), float(scores[0][0])
+                item = cache['answers'].get(answer_id)
+                if item is not None and score >= self.threshold:
+                    if item[0] >= time.monotonic():
+                        self.scopes.move_to_end(scope)
+                        cache['answers'].move_to_end(answer_id)
+                        self.hits += 1
+                        return item[2], item[1], score
+                    self.remove(cache, [answer_id])
+            self.misses += 1
+            return None
+
+    def put(self, scope, embedding, query, answer):
+        with self.lock:
+            cache = self.scopes.get(scope)
+            if cache is None:
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(len(embedding)))
+                cache = self.scopes[scope] = {'index': index, 'answers': OrderedDict(), 'next': 0}
+                while len(self.scopes) > self.max_scopes:
+                    self.scopes.popitem(last=False)
+            self.scopes.move_to_end(scope)
+            answer_id = cache['next']
+            cache['next'] += 1
+            cache['index'].add_with_ids(embedding.reshape(1, -1).astype('float32'), np.array([answer_id], dtype='int64'))
+            cache['answers'][answer_id] = (time.monotonic() + self.ttl, query, answer)
+            if len(cache['answers']) > self.max_size:
+                self.remove(cache, list(cache['answers'])[:len(cache['answers']) - self.max_size])
+
+    def remove(self, cache, answer_ids):
+        cache['index'].remove_ids(np.array(answer_ids, dtype='int64'))
+        for answer_id in answer_ids:
+            del cache['answers'][answer_id]
+
+    def invalidate(self, file_base=None):
+        #Drop the scopes of one document and every multi-document scope, or everything when file_base is None
+        with self.lock:
+            for scope in [s for s in self.scopes if file_base is None or s[0] in (file_base, "*")]:
+                del self.scopes[scope]
+
+    def stats(self):
+        with self.lock:
+            return {'scopes': len(self.scopes), 'size': sum(len(c['answers']) for c in self.scopes.values()),
+                    'hits': self.hits, 'misses': self.misses}
+
+query_embedding_cache=TTLCache(query_cache_size, query_cache_ttl)#query text -> embedding
+result_cache=TTLCache(query_cache_size, query_cache_ttl)#(file, index version, embedding, top_k, ...) -> hits
+llm_cache=TTLCache(query_cache_size, llm_cache_ttl)#prompt hash -> LLM response
+answer_cache=SemanticCache(semantic_cache_size, semantic_cache_threshold, llm_cache_ttl)#similar query -> final answer
+
+def cache_stats():
+    #Hit/miss counters of every query-side cache layer
+    return {'embeddings': query_embedding_cache.stats(), 'results': result_cache.stats(), 'llm': llm_cache.stats(),
+            'answers': answer_cache.stats()}
+
+def encode_queries(embedding_model, queries):
+    #Encode query texts, reusing cached embeddings and encoding the rest in one batch
+    cached = [query_embedding_cache.get(q) for q in queries]
+    missing = [i for i, e in enumerate(cached) if e is None]
+    count('query_embedding_cache_hits', len(queries) - len(missing))
+    if missing:
+        with span('query_encode', queries=len(missing)):
+            encoded = normalize_rows(embedding_model.encode([queries[i] for i in missing], batch_size=embed_batch_size,
+                                                            show_progress_bar=False))
+        for row, i in enumerate(missing):
+            cached[i] = encoded[row]
+            query_embedding_cache.put(queries[i], encoded[row])
+    if not cached:
+        return np.zeros((0, embedding_model.get_sentence_embedding_dimension()), dtype='float32')
+    return np.vstack(cached).astype('float32')
+
+def answer_scope(file_base, files, settings):
+    #Semantic cache scope of an answer: the searched document(s) at their current index version
+    #(the committed generation and its file times) plus the settings that shape the answer.
+    #None when there is no index to answer from yet, so the query goes through the normal path.
+    try:
+        if file_base:
+            entry = load_index(file_base)
+            return (file_base, entry['stem'], entry['mtimes'], settings)
+        file_bases = sorted(files) if files else indexed_files()
+        return ("*", json.dumps(corpus_signature(file_bases)), settings)
+    except FileNotFoundError:
+        return None
+
+def normalize_rows(embeddings):
+    #Unit-length float32 copy of a matrix of embeddings, so inner product is cosine similarity
+    normalized = np.array(embeddings, dtype='float32', copy=True, order='C')
+    faiss.normalize_L2(normalized)
+    return normalized
+
+def embedding_key(embedding):
+    return hashlib.sha1(np.ascontiguousarray(embedding).tobytes()).hexdigest()
+
+def get_embedding_model():
+    #Load the sentence transformer once per process and share it across sessions and modules
+    model = embedding_model_state['model']
+    if model is None:
+        with embedding_model_lock:
+            if embedding_model_state['model'] is None:
+                from sentence_transformers import SentenceTransformer
+                embedding_model_state['model'] = SentenceTransformer(embedding_model_name)
+            model = embedding_model_state['model']
+    return model
+
+def warm_up_model():
+    #Load the model and encode a dummy query in a background thread. Safe to call on every rerun.
+    with embedding_model_lock:
+        if embedding_model_state['warming']:
+            return
+        embedding_model_state['warming'] = True
+
+    def run():
+        try:
+            get_embedding_model().encode(["warm up"], show_progress_bar=False)
+            embedding_model_state['warm'] = True
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+def index_paths(file_base):
+    #Return the FAISS index and chunk table paths for a file base name
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")  # Folder where files are indexed
+    return (os.path.join(index_folder, f"{file_base}__index.faiss"),
+            os.path.join(index_folder, f"{file_base}__chunks.json"))
+
+def generation_pointer_path(file_base):
+    return os.path.join(os.getcwd(), "indexed_pdfs", f"{file_base}__current.json")
+
+def current_generation(file_base):
+    #Committed generation of file_base, 0 for unversioned files
+    try:
+        with open(generation_pointer_path(file_base), "r") as f:
+            return json.loads(f.read())['generation']
+    except FileNotFoundError:
+        return 0
+
+def generation_stem(file_base, generation=None):
+    #Name prefix shared by the files of one generation (the committed one by default)
+    generation = current_generation(file_base) if generation is None else generation
+    return f"{file_base}__g{generation}" if generation else file_base
+
+def generation_files(file_base):
+    #(generation, file name) of every generation file on disk, committed or not
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    pattern = re.compile(rf"{re.escape(file_base)}__g(\d+)__")
+    unversioned = {f"{file_base}__{part}" for part in ("index.faiss", "texts.bin", "offsets.npy", "chunks.json",
+                                                        "ids.bin", "id_offsets.npy", "codes.npy",
+                                                        "bm25.npz", "vectors.npy", "metadata.pkl")}
+    files = []
+    for name in os.listdir(index_folder):
+        match = pattern.match(name)
+        if match:
+            files.append((int(match.group(1)), name))
+        elif name in unversioned:
+            files.append((0, name))
+    return files
+
+def next_generation(file_base):
+    #Number for a new generation, above the committed one and any abandoned partial write
+    return max([current_generation(file_base)] + [generation for generation, _ in generation_files(file_base)]) + 1
+
+def commit_generation(file_base, generation):
+    #Atomically switch readers to a fully written generation, then garbage-collect the generations
+    #older than the index_generations_kept most recent ones. Readers still holding a removed generation
+    #keep working on their open (memory-mapped) files. Unversioned files (generation 0) are never removed,
+    #they are the indexes shipped with the repository.
+    path = generation_pointer_path(file_base)
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps({'generation': generation, 'committed': time.time()}))
+    os.replace(path + ".tmp", path)
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    for number, name in generation_files(file_base):
+        if 0 < number <= generation - index_generations_kept:
+            try:
+                os.remove(os.path.join(index_folder, name))
+            except OSError as e:
+                print(f"Unable to remove old index file {name}: {e}")
+
+def chunk_store_paths(file_base):
+    #Text blob, text offsets and columnar metadata table of a file's chunk store
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    return (os.path.join(index_folder, f"{file_base}__texts.bin"),
+            os.path.join(index_folder, f"{file_base}__offsets.npy"),
+            os.path.join(index_folder, f"{file_base}__chunks.json"))
+
+def write_chunk_store(file_base, ids, texts, metadatas):
+    #Write chunk texts as one UTF-8 blob with an offsets array, and metadata as dictionary-encoded columns.
+    #Files are replaced rather than rewritten so stores already memory-mapped by readers stay valid.
+    #The table is written last so its mtime marks a complete store.
+    texts_path, offsets_path, table_path = chunk_store_paths(file_base)
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with open(texts_path + ".tmp", 'wb') as f:
+        f.write(b''.join(encoded))
+    os.replace(texts_path + ".tmp", texts_path)
+    with open(offsets_path + ".tmp", 'wb') as f:
+        np.save(f, offsets)
+    os.replace(offsets_path + ".tmp", offsets_path)
+    write_chunk_table(file_base, ids, metadatas)
+
+def chunk_table_paths(file_base):
+    #Id blob, id offsets and int32 metadata codes of a file's chunk table
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    return (os.path.join(index_folder, f"{file_base}__ids.bin"),
+            os.path.join(index_folder, f"{file_base}__id_offsets.npy"),
+            os.path.join(index_folder, f"{file_base}__codes.npy"))
+
+def write_chunk_table(file_base, ids, metadatas):
+    #Write chunk ids as one UTF-8 blob with an offsets array, and metadata as dictionary-encoded int32 codes
+    #(one column per field, -1 where a row lacks it). Only the value dictionaries go in the JSON table.
+    #ids and metadatas are read once, so they may be generators.
+    ids_path, id_offsets_path, codes_path = chunk_table_paths(file_base)
+    id_offsets = array('q', [0])
+    with open(ids_path + ".tmp", 'wb') as f:
+        for id_ in ids:
+            encoded = id_.encode('utf-8')
+            f.write(encoded)
+            id_offsets.append(id_offsets[-1] + len(encoded))
+    os.replace(ids_path + ".tmp", ids_path)
+    with open(id_offsets_path + ".tmp", 'wb') as f:
+        np.save(f, np.frombuffer(id_offsets, dtype='int64'))
+    os.replace(id_offsets_path + ".tmp", id_offsets_path)
+
+    values, positions, codes = {}, {}, {}
+    for row, metadata in enumerate(metadatas):
+        for name, value in metadata.items():
+            if name not in values:
+                values[name], positions[name], codes[name] = [], {}, array('i', [-1]) * row
+            key = json.dumps(value, default=str)
+            if key not in positions[name]:
+                positions[name][key] = len(values[name])
+                values[name].append(value)
+            codes[name].append(positions[name][key])
+        for column in codes.values():
+            if len(column) == row:
+                column.append(-1)
+    names = sorted(values)
+    table = np.full((len(id_offsets) - 1, len(names)), -1, dtype='int32')
+    for j, name in enumerate(names):
+        column = np.frombuffer(codes[name], dtype='int32')[:len(table)]
+        table[:len(column), j] = column
+    with open(codes_path + ".tmp", 'wb') as f:
+        np.save(f, table)
+    os.replace(codes_path + ".tmp", codes_path)
+
+    table_path = chunk_store_paths(file_base)[2]
+    with open(table_path + ".tmp", "w") as f:
+        f.write(json.dumps({'columns': {name: values[name] for name in names}}, default=str, ensure_ascii=False))
+    os.replace(table_path + ".tmp", table_path)
+
+class ChunkStore:
+    #Read-only view of a chunk store. Texts, ids and metadata codes stay memory-mapped and are decoded per row on demand.
+    def __init__(self, file_base):
+        texts_path, offsets_path, table_path = chunk_store_paths(file_base)
+        ids_path, id_offsets_path, codes_path = chunk_table_paths(file_base)
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        self.texts = np.memmap(texts_path, dtype=np.uint8, mode='r') if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        self.id_offsets = np.load(id_offsets_path, mmap_mode='r')
+        self.id_blob = np.memmap(ids_path, dtype=np.uint8, mode='r') if self.id_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        self.codes = np.load(codes_path, mmap_mode='r')
+        with open(table_path, "r") as f:
+            raw = f.read()
+        columns = json.loads(raw)['columns']
+        self.names = list(columns)
+        self.values = list(columns.values())
+        self.table_bytes = len(raw)
+
+    def __len__(self):
+        return len(self.id_offsets) - 1
+
+    def id(self, i):
+        return bytes(self.id_blob[self.id_offsets[i]:self.id_offsets[i + 1]]).decode('utf-8')
+
+    def text(self, i):
+        return bytes(self.texts[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def metadata(self, i):
+        return {name: values[code] for name, values, code in zip(self.names, self.values, self.codes[i].tolist())
+                if code >= 0}
+
+    def resident_bytes(self):
+        #Rough size of the parts held in memory (the metadata value dictionaries), texts, ids and codes are paged in by the OS
+        return 4 * self.table_bytes
+
+def migrate_pickle_metadata(file_base):
+    #Convert a legacy {file}__metadata.pkl into a chunk store and remove the pickle
+    legacy_path = os.path.join(os.getcwd(), "indexed_pdfs", f"{file_base}__metadata.pkl")
+    with open(legacy_path, 'rb') as f:
+        metadata = pickle.load(f)
+    records = sorted(metadata.items(), key=lambda item: item[1]['faiss_index'])
+    write_chunk_store(file_base, [id_ for id_, _ in records], [r['text'] for _, r in records],
+                      [r['metadata'] for _, r in records])
+    os.remove(legacy_path)
+    print(f"Migrated {legacy_path} to a chunk store")
+
+def migrate_json_chunk_table(file_base):
+    #Convert a chunk table written with its ids and codes inline in {file}__chunks.json. The table keeps its
+    #mtime so caches and the BM25 index built from it stay valid.
+    table_path = chunk_store_paths(file_base)[2]
+    with open(table_path, "r") as f:
+        table = json.loads(f.read())
+    mtime = os.path.getmtime(table_path)
+    columns = table['columns']
+    metadatas = ({name: column['values'][column['codes'][row]] for name, column in columns.items() if column['codes'][row] >= 0}
+                 for row in range(len(table['ids'])))
+    write_chunk_table(file_base, table['ids'], metadatas)
+    os.utime(table_path, (mtime, mtime))
+    print(f"Migrated {table_path} to memory-mapped ids and codes")
+
+def tokenize(text):
+    #Lowercased word and number tokens without stopwords, shared by BM25 indexing and querying
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in stopwords]
+
+def bm25_path(file_base):
+    return os.path.join(os.getcwd(), "indexed_pdfs", f"{file_base}__bm25.npz")
+
+def write_bm25_index(file_base, texts):
+    #Inverted index over chunk texts (any iterable) in FAISS order: sorted vocabulary plus one flat array
+    #of posting lists (chunk positions and term frequencies) addressed by per-term offsets
+    postings = {}
+    lengths = []
+    for doc, text in enumerate(texts):
+        tokens = tokenize(text)
+        lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc, tf))
+    doc_lens = np.array(lengths, dtype='int32')
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+    docs = np.fromiter((doc for term in terms for doc, _ in postings[term]), dtype='int32', count=offsets[-1])
+    tfs = np.fromiter((min(tf, 65535) for term in terms for _, tf in postings[term]), dtype='uint16', count=offsets[-1])
+    path = bm25_path(file_base)
+    with open(path + ".tmp", 'wb') as f:
+        np.savez(f, terms=np.frombuffer("\n".join(terms).encode('utf-8'), dtype=np.uint8),  # Tokens never contain newlines
+                 offsets=offsets, docs=docs, tfs=tfs, doc_lens=doc_lens)
+    os.replace(path + ".tmp", path)
+
+class Bm25Index:
+    #Read-only BM25 index written by write_bm25_index
+    def __init__(self, file_base):
+        data = np.load(bm25_path(file_base))
+        terms = data['terms'].tobytes().decode('utf-8').split("\n") if data['terms'].size else []
+        self.lookup = {term: i for i, term in enumerate(terms)}
+        self.offsets = data['offsets']
+        self.docs = data['docs']
+        self.tfs = data['tfs'].astype('float32')
+        self.doc_lens = data['doc_lens'].astype('float32')
+        self.avg_len = max(float(self.doc_lens.mean()), 1.0) if len(self.doc_lens) else 1.0
+
+    def search(self, query, top_k):
+        #Chunk positions and scores of the top_k chunks sharing at least one term with the query
+        n = len(self.doc_lens)
+        scores = np.zeros(n, dtype='float32')
+        for term in set(tokenize(query)):
+            t = self.lookup.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            docs, tf = self.docs[start:end], self.tfs[start:end]
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tf * (bm25_k1 + 1) / (tf + bm25_k1 * (1 - bm25_b + bm25_b * self.doc_lens[docs] / self.avg_len))
+        hits = np.flatnonzero(scores)
+        top = hits[np.argsort(-scores[hits], kind='stable')[:top_k]]
+        return top, scores[top]
+
+def load_bm25(file_base, entry):
+    #BM25 index of a cached index entry, loaded on first use. Indexes written before BM25 existed
+    #(or older than their chunk table) are rebuilt from the chunk store.
+    with bm25_lock:
+        if entry.get('bm25') is None:
+            path = bm25_path(entry['stem'])
+            if not os.path.isfile(path) or os.path.getmtime(path) < entry['mtimes'][1]:
+                with span('bm25_build', file=file_base):
+                    store = entry['store']
+                    write_bm25_index(entry['stem'], [store.text(i) for i in range(len(store))])
+            entry['bm25'] = Bm25Index(entry['stem'])
+        return entry['bm25']
+
+def rrf_fuse(rankings, top_k):
+    #Reciprocal rank fusion of several ranked lists of chunk positions -> [(position, fused score)]
+    scores = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            scores[int(idx)] = scores.get(int(idx), 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+
+def manifest_path():
+    #Manifest recording how each file in indexed_pdfs/ was built
+    return os.path.join(os.getcwd(), "indexed_pdfs", "index_manifest.json")
+
+def load_manifest():
+    if not os.path.isfile(manifest_path()):
+        return {}
+    with open(manifest_path(), "r") as f:
+        return json.loads(f.read())
+
+def file_fingerprint(path, previous=None):
+    #Size, mtime and content hash of a source file. The hash is reused when size and mtime are unchanged.
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime:
+        return {'sha256': previous['sha256'], 'size': stat.st_size, 'mtime': stat.st_mtime}
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'sha256': digest.hexdigest(), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def is_index_current(file_name, path, chunk_size, chunk_overlap, manifest=None, index_type=None, precision=None):
+    #True when file_name is already indexed from identical content with the same settings
+    manifest = load_manifest() if manifest is None else manifest
+    entry = manifest.get(file_name)
+    if entry is None or not all(os.path.isfile(p) for p in index_paths(generation_stem(file_name))):
+        return False
+    settings = (chunk_size, chunk_overlap, embedding_model_name, index_type or default_index_type, precision or default_precision)
+    if (entry.get('chunk_size'), entry.get('chunk_overlap'), entry.get('model'), entry.get('index_type', 'flat'),
+            entry.get('precision', 'float32')) != settings:
+        return False
+    return file_fingerprint(path, entry)['sha256'] == entry.get('sha256')
+
+def update_manifest(file_name, path, chunk_size, chunk_overlap, chunks, index_type=None, index=None, precision=None):
+    #Record the source hash, chunk settings, index type and storage precision of a freshly written index
+    with manifest_lock:
+        manifest = load_manifest()
+        entry = file_fingerprint(path, manifest.get(file_name))
+        entry.update({'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap,
+                      'model': embedding_model_name, 'chunks': chunks,
+                      'index_type': index_type or default_index_type, 'precision': precision or default_precision})
+        if index is not None:
+            entry['faiss_index_type'] = describe_index(index)  # May fall back to flat for small files
+        manifest[file_name] = entry
+        with open(manifest_path() + ".tmp", "w") as f:
+            f.write(json.dumps(manifest, indent=2, ensure_ascii=False))
+        os.replace(manifest_path() + ".tmp", manifest_path())
+
+def embedding_cache_path():
+    return os.path.join(os.getcwd(), "indexed_pdfs", f"{embedding_model_name}__embeddings.npz")
+
+def load_embedding_cache():
+    #Load cached chunk embeddings from disk once per process
+    with embedding_cache_lock:
+        if embedding_cache_state['loaded']:
+            return
+        if os.path.isfile(embedding_cache_path()):
+            try:
+                data = np.load(embedding_cache_path())
+                keys = data['keys'].tolist()[-embedding_cache_max:]  # Saved least recently used first
+                embedding_cache.update(zip(keys, data['vectors'][len(data['keys']) - len(keys):]))
+            except Exception as e:
+                print(f"Unable to load embedding cache: {e}")
+        embedding_cache_state['loaded'] = True
+
+def save_embedding_cache():
+    #Persist the cached embeddings in least recently used order
+    with embedding_cache_lock:
+        if not embedding_cache_state['dirty']:
+            return
+        keys = list(embedding_cache.keys())
+        vectors = np.stack([embedding_cache[k] for k in keys]) if keys else np.zeros((0, 0), dtype='float32')
+        np.savez(embedding_cache_path(), keys=np.array(keys), vectors=vectors)
+        embedding_cache_state['dirty'] = False
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def index_mtimes(stem):
+    #Modification times of a generation's index/chunk table pair, used to detect files rewritten on disk
+    if not os.path.isfile(chunk_table_paths(stem)[2]):
+        if os.path.isfile(index_paths(stem)[1]):
+            migrate_json_chunk_table(stem)
+        else:
+            migrate_pickle_metadata(stem)
+    return tuple(os.path.getmtime(path) for path in index_paths(stem))
+
+def vector_bytes(index):
+    #Bytes held in memory per stored vector (float32 unless the index stores compact codes)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    return getattr(index, 'code_size', 0) or index.d * 4
+
+def estimate_index_bytes(index, store):
+    #Approximate resident size of a loaded index plus the in-memory part of its chunk store.
+    #Rescoring vectors are memory-mapped and paged in by the OS, so they are not counted.
+    return index.ntotal * vector_bytes(index) + store.resident_bytes()
+
+def cache_index(file_base, index, store, mtimes, vectors=None, stem=None):
+    #Store a loaded index in the cache and evict least recently used entries over budget
+    entry = {
+        'stem': stem or file_base,  # Generation the entry was loaded from
+        'index': index,
+        'store': store,  # FAISS position i is row i of the chunk store
+        'vectors': vectors,  # float32 rescoring vectors of compact indexes (memory-mapped), else None
+        'mtimes': mtimes,
+        'size': estimate_index_bytes(index, store),
+    }
+    with index_cache_lock:
+        index_cache.pop(file_base, None)
+        index_cache[file_base] = entry
+        total = sum(e['size'] for e in index_cache.values())
+        while total > index_cache_budget and len(index_cache) > 1:
+            _, evicted = index_cache.popitem(last=False)
+            total -= evicted['size']
+    return entry
+
+def invalidate_index(file_base=None):
+    #Drop a cached index (or every index when file_base is None)
+    with index_cache_lock:
+        if file_base is None:
+            index_cache.clear()
+        else:
+            index_cache.pop(file_base, None)
+    result_cache.purge(None if file_base is None else (lambda key: key[0] == file_base))
+    answer_cache.invalidate(file_base)
+
+def load_index(file_base):
+    #Return the cached index entry for file_base, reloading from disk when a new generation was committed
+    #or the files changed. Never waits for a writer: a generation garbage-collected while it was being
+    #loaded is retried once from the new pointer.
+    try:
+        return load_generation(file_base)
+    except FileNotFoundError:
+        count('index_generation_retries')
+        return load_generation(file_base)
+
+def load_generation(file_base):
+    stem = generation_stem(file_base)
+    mtimes = index_mtimes(stem)
+    with index_cache_lock:
+        entry = index_cache.get(file_base)
+        if entry is not None and entry['stem'] == stem and entry['mtimes'] == mtimes:
+            index_cache.move_to_end(file_base)
+            count('index_cache_hits')
+            return entry
+    count('index_cache_misses')
+    with span('index_load', file=file_base):
+        index = read_index_file(index_paths(stem)[0])
+        vectors = load_rescore_vectors(stem, index)
+        if not vectors_normalized(index, vectors):
+            index, vectors = normalize_index(stem, index, vectors)
+            mtimes = index_mtimes(stem)
+        entry = cache_index(file_base, index, ChunkStore(stem), mtimes, vectors, stem)
+    count('index_vectors_loaded', index.ntotal)
+    return entry
 
 def llama_simple_reader(path):
     #Read PDF file
+    from llama_index.core import SimpleDirectoryReader
     try:
         documents = SimpleDirectoryReader(input_files=[path]).load_data()
         return documents
+    except TimeoutError:
+        raise  # Raised by run_with_timeout, the caller records it as a failed file
     except Exception as e:
         print(f"Unable to read: {path}: {e}")
         return []
 
+def source_metadata(path):
+    #File metadata attached to every extracted document, as SimpleDirectoryReader does
+    from llama_index.core.readers.file.base import default_file_metadata_func
+    return default_file_metadata_func(path)
+
+def record_text(record, prefix=""):
+    #Flatten a JSON/CSV record into "field: value" lines, nested fields joined with dots
+    if isinstance(record, dict):
+        return "\n".join(record_text(value, f"{prefix}{key}.") for key, value in record.items()
+                         if value not in (None, "", [], {}))
+    if isinstance(record, list):
+        return "\n".join(record_text(value, prefix) for value in record)
+    return f"{prefix[:-1]}: {record}" if prefix else str(record)
+
+def extract_csv(path):
+    #One document per CSV row, so each row is chunked (and retrieved) on its own
+    from llama_index.core import Document
+    metadata = source_metadata(path)
+    with open(path, "r", encoding="utf-8-sig", errors="replace", newline="") as f:
+        rows = csv.DictReader(f)
+        return [Document(text=record_text(row), metadata={'page_label': f"row {number}", **metadata})
+                for number, row in enumerate(rows, start=1) if any(row.values())]
+
+def extract_json(path):
+    #One document per record: the items of a top-level list, otherwise each top-level field
+    from llama_index.core import Document
+    metadata = source_metadata(path)
+    with open(path, "r", encoding="utf-8-sig") as f:
+        data = json.loads(f.read())
+    records = data if isinstance(data, list) else [{key: value} for key, value in data.items()] if isinstance(data, dict) else [data]
+    return [Document(text=record_text(record), metadata={'page_label': f"record {number}", **metadata})
+            for number, record in enumerate(records, start=1) if record_text(record)]
+
+def extract_jsonl(path):
+    #One document per JSON line
+    from llama_index.core import Document
+    metadata = source_metadata(path)
+    documents = []
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for number, line in enumerate(f, start=1):
+            if line.strip():
+                documents.append(Document(text=record_text(json.loads(line)), metadata={'page_label': f"line {number}", **metadata}))
+    return documents
+
+#Extractor registry: file extension -> function(path) returning llama Documents. Structured formats
+#produce one document per row/record and never go through the PDF reader. The chunker still splits
+#records longer than chunk_size. Register new formats here at import time so the extraction worker
+#processes see them too. The order is the lookup order when several files share a base name.
+extractors={
+    'pdf': llama_simple_reader,
+    'docx': llama_simple_reader,  # Needs docx2txt
+    'pptx': llama_simple_reader,  # Needs python-pptx
+    'txt': llama_simple_reader,
+    'md': llama_simple_reader,
+    'csv': extract_csv,
+    'json': extract_json,
+    'jsonl': extract_jsonl,
+}
+
+def source_format(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+def source_path(file_name):
+    #Source file of a base name in the PDF folder, trying the registered formats in order. A base name
+    #shared by several formats is rejected, since indexes and the manifest are keyed by base name.
+    pdf_folder = os.path.join(os.getcwd(), "PDF")
+    paths = [os.path.join(pdf_folder, f"{file_name}.{extension}") for extension in extractors]
+    paths = [path for path in paths if os.path.isfile(path)]
+    if len(paths) > 1:
+        raise ValueError(f"{file_name} is shared by {', '.join(os.path.basename(p) for p in paths)}, rename all but one")
+    return paths[0] if paths else os.path.join(pdf_folder, f"{file_name}.pdf")
+
+def source_listing():
+    #Files of a registered format in the PDF folder, grouped by base name
+    pdf_folder = os.path.join(os.getcwd(), "PDF")
+    sources = {}
+    if os.path.isdir(pdf_folder):
+        for f in sorted(os.listdir(pdf_folder)):
+            if source_format(f) in extractors:
+                sources.setdefault(os.path.splitext(f)[0], []).append(f)
+    return sources
+
+def source_files():
+    #Base names of the files in the PDF folder that can be indexed (one source per base name)
+    return sorted(base for base, files in source_listing().items() if len(files) == 1)
+
+def shared_source_bases():
+    #Base names used by more than one format in the PDF folder, e.g. report.pdf and report.csv.
+    #These are not indexed until all but one are renamed.
+    return {base: files for base, files in source_listing().items() if len(files) > 1}
+
+def extract_documents(path):
+    #Documents of any registered format
+    extractor = extractors.get(source_format(path))
+    if extractor is None:
+        raise ValueError(f"No extractor for {path}")
+    return extractor(path)
+
 def chunk_documents(file_name, documents, path, chunk_size, chunk_overlap):
     #Split the document given the chunk size and chunk overlap.
+    from llama_index.core.node_parser import SimpleNodeParser
     record_dict = {}
     parser = SimpleNodeParser.from_defaults(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     nodes = parser.get_nodes_from_documents(documents)
@@ -40,45 +854,371 @@ def chunk_documents(file_name, documents, path, chunk_size, chunk_overlap):
         record_dict[ID] = node
     return nodes, record_dict
 
-def embed_record_dict(record_dict, embedding_model):
-    #Generate embeddings
-    embeddings = []
-    ids = []
-    for doc_id, node in record_dict.items():
-        text = node.text#Return text
-        embedding = embedding_model.encode(text, show_progress_bar=False)
-        embeddings.append(embedding)
-        ids.append(doc_id)#List of document/record IDs
+def embed_record_dict(record_dict, embedding_model, batch_size=None):
+    #Generate embeddings in length-bucketed batches, written straight into a float32 array
+    ids = list(record_dict.keys())#List of document/record IDs
+    embeddings = embed_texts([record_dict[doc_id].text for doc_id in ids], embedding_model, batch_size)
+    print(f"Embedded {embed_stats['chunks'] - embed_stats['cached']} chunks in {embed_stats['seconds']:.2f}s "
+          f"({embed_stats['chunks_per_sec']:.1f} chunks/s), {embed_stats['cached']} reused from cache")
     return embeddings, ids
 
-def index_embeddings(embeddings, ids, record_dict, file_name):
-    cwd = os.getcwd()  # Current working directory
-    index_folder = os.path.join(cwd, "indexed_pdfs")  # Folder where files are indexed
-    embeddings_array = np.array(embeddings).astype('float32')
-    dimension = embeddings_array.shape[1]
-    index = faiss.IndexFlatIP(dimension)
+def embed_texts(texts, embedding_model, batch_size=None, use_cache=True):
+    #Embeddings of texts, reusing the chunk embedding cache unless use_cache is False (the cache is neither
+    #loaded nor filled then). Throughput is recorded in embed_stats.
+    batch_size = batch_size or embed_batch_size
+    hashes = [text_hash(text) for text in texts] if use_cache else []
+    dimension = embedding_model.get_sentence_embedding_dimension()
+    embeddings = np.empty((len(texts), dimension), dtype='float32')
+
+    # Reuse embeddings of chunks whose text was already embedded (e.g. overlaps under new settings)
+    missing = [] if use_cache else list(range(len(texts)))
+    if use_cache:
+        load_embedding_cache()
+    with embedding_cache_lock:
+        for i, key in enumerate(hashes):
+            cached = embedding_cache.get(key)
+            if cached is not None and cached.shape[0] == dimension:
+                embedding_cache.move_to_end(key)
+                embeddings[i] = cached
+            else:
+                missing.append(i)
+
+    # Sort by length so each batch pads to similar sequence lengths
+    order = sorted(missing, key=lambda i: len(texts[i]))
+    start = time.perf_counter()
+    for pos in range(0, len(order), batch_size):
+        rows = order[pos:pos + batch_size]
+        batch = embedding_model.encode([texts[i] for i in rows], batch_size=batch_size,
+                                       show_progress_bar=False, convert_to_numpy=True)
+        embeddings[rows] = batch
+    elapsed = time.perf_counter() - start
+
+    if missing and use_cache:
+        with embedding_cache_lock:
+            for i in missing:
+                embedding_cache[hashes[i]] = embeddings[i].copy()
+                embedding_cache.move_to_end(hashes[i])
+            while len(embedding_cache) > embedding_cache_max:
+                embedding_cache.popitem(last=False)
+            embedding_cache_state['dirty'] = True
+
+    embed_stats.update({
+        'chunks': len(texts),
+        'cached': len(texts) - len(missing),
+        'seconds': elapsed,
+        'chunks_per_sec': len(missing) / elapsed if elapsed > 0 else 0.0,
+        'batch_size': batch_size,
+    })
+    return embeddings
+
+def binarize(embeddings_array):
+    #One sign bit per dimension, packed 8 per byte, for binary indexes
+    return np.packbits(np.asarray(embeddings_array) > 0, axis=1)
+
+def make_index(embeddings_array, index_type=None, precision=None):
+    #Build a FAISS inner-product index of the requested type (flat, ivf_flat, ivf_pq or hnsw) storing
+    #vectors at the requested precision (float32, float16, int8 scalar quantized, or binary sign bits).
+    #IVF/PQ quantizers are trained on a sample; collections too small to train fall back to flat.
+    index_type = index_type or default_index_type
+    precision = precision or default_precision
+    n, dimension = embeddings_array.shape
+    if precision == "binary":
+        if index_type != "flat":
+            print(f"Binary storage uses a flat index, ignoring index type {index_type}")
+        index = faiss.IndexBinaryFlat(dimension)
+        index.add(binarize(embeddings_array))
+        return index
+    if precision not in storage_precisions:
+        print(f"Unknown storage precision {precision}, using float32")
+    qtype = {'float16': faiss.ScalarQuantizer.QT_fp16, 'int8': faiss.ScalarQuantizer.QT_8bit}.get(precision)
+    nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))  # FAISS wants ~39 training points per list
+    if index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, qtype, 32, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_flat" and nlist > 1:
+        codes = {'float16': "SQfp16", 'int8': "SQ8"}.get(precision, "Flat")
+        index = faiss.index_factory(dimension, f"IVF{nlist},{codes}", faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_pq" and nlist > 1 and n >= 256 * 39 and dimension % 8 == 0:
+        index = faiss.index_factory(dimension, f"IVF{nlist},PQ{dimension // 8}", faiss.METRIC_INNER_PRODUCT)
+    else:
+        if index_type not in ("flat", "ivf_flat", "ivf_pq"):
+            print(f"Unknown index type {index_type}, using flat")
+        if qtype is None:
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+
+    if not index.is_trained:
+        sample = embeddings_array
+        if n > ann_train_sample:
+            sample = embeddings_array[np.random.default_rng(0).choice(n, ann_train_sample, replace=False)]
+        index.train(sample)
     index.add(embeddings_array)
+    return index
+
+def describe_index(index):
+    #Name of the index type as used by make_index
+    if isinstance(index, faiss.IndexBinary):
+        return "flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def index_precision(index):
+    #Storage precision of an index as used by make_index (PQ codes count as float32, they are not rescored)
+    if isinstance(index, faiss.IndexBinary):
+        return "binary"
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    sq = getattr(index, 'sq', None)
+    if sq is not None:
+        return {faiss.ScalarQuantizer.QT_fp16: "float16", faiss.ScalarQuantizer.QT_8bit: "int8"}.get(sq.qtype, "float32")
+    return "float32"
+
+def write_index_file(index, path):
+    #Write a float or binary FAISS index
+    if isinstance(index, faiss.IndexBinary):
+        faiss.write_index_binary(index, path)
+    else:
+        faiss.write_index(index, path)
+
+def read_index_file(path):
+    #Read a float or binary FAISS index (binary index files start with an "IB" fourcc)
+    with open(path, 'rb') as f:
+        binary = f.read(2) == b"IB"
+    return faiss.read_index_binary(path) if binary else faiss.read_index(path)
+
+def rescore_vectors_path(file_base):
+    return os.path.join(os.getcwd(), "indexed_pdfs", f"{file_base}__vectors.npy")
+
+def load_rescore_vectors(file_base, index):
+    #Memory-mapped float32 vectors used to re-rank the candidates of a compact index
+    path = rescore_vectors_path(file_base)
+    if index_precision(index) == "float32" or not os.path.isfile(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+def vectors_normalized(index, vectors, sample=256):
+    #False for indexes written before vectors were normalized. Quantized codes without their float32
+    #vectors (PQ, or a missing vectors file) cannot be checked or rebuilt exactly and are left alone.
+    if vectors is not None:
+        stored = np.asarray(vectors[:sample], dtype='float32')
+    elif index_precision(index) != "float32" or describe_index(index) == "ivf_pq" or index.ntotal == 0:
+        return True
+    else:
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        stored = index.reconstruct_n(0, min(sample, index.ntotal))
+    norms = np.linalg.norm(stored, axis=1)
+    return bool(np.all((np.abs(norms - 1) < 1e-3) | (norms == 0)))
+
+def normalize_index(stem, index, vectors):
+    #Migrate an index of unnormalized vectors in place, keeping its type and storage precision
+    with migration_lock:
+        exact = normalize_rows(vectors if vectors is not None else index_vectors(index))
+        index = make_index(exact, describe_index(index), index_precision(index))
+        if vectors is not None:
+            vectors_path = rescore_vectors_path(stem)
+            with open(vectors_path + ".tmp", 'wb') as f:
+                np.save(f, exact)
+            os.replace(vectors_path + ".tmp", vectors_path)
+            vectors = np.load(vectors_path, mmap_mode='r')
+        index_path = index_paths(stem)[0]
+        write_index_file(index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+    print(f"Normalized the vectors of {index_path}")
+    return index, vectors
+
+def search_index(entry, query_embeddings, k, nprobe=None, ef_search=None, selector=None):
+    #Search a cached index entry, returning FAISS style (scores, positions). selector optionally limits the
+    #search to some positions (a FAISS IDSelector).
+    #Compact indexes are searched in two stages: a coarse scan of the compact codes for rescore_factor*k
+    #candidates, then an exact inner-product re-rank of those candidates against the float32 vectors.
+    index = entry['index']
+    vectors = entry.get('vectors')
+    depth = min(k * rescore_factor, index.ntotal) if vectors is not None else k
+    params = search_params(index, nprobe, ef_search, selector)
+    if isinstance(index, faiss.IndexBinary):
+        hamming, indices = index.search(binarize(query_embeddings), depth, params=params)
+        distances = 1 - 2 * hamming.astype('float32') / index.d  # Fraction of agreeing signs mapped to [-1, 1]
+    else:
+        distances, indices = index.search(query_embeddings, depth, params=params)
+    if vectors is None:
+        return distances, indices
+    scores = np.full((len(query_embeddings), k), -np.inf, dtype='float32')
+    positions = np.full((len(query_embeddings), k), -1, dtype='int64')
+    for row, candidates in enumerate(indices):
+        candidates = np.sort(candidates[candidates >= 0])  # Ascending rows read the memory map sequentially
+        exact = np.asarray(vectors[candidates], dtype='float32') @ query_embeddings[row]
+        order = np.argsort(-exact)[:k]
+        scores[row, :len(order)] = exact[order]
+        positions[row, :len(order)] = candidates[order]
+    return scores, positions
+
+def search_params(index, nprobe=None, ef_search=None, selector=None):
+    #Per-query accuracy/speed knobs for IVF and HNSW indexes, plus an optional IDSelector (None for an unfiltered flat index)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe or ann_nprobe, sel=selector)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or ann_ef_search, sel=selector)
+    return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+def index_vectors(index):
+    #Stored vectors of an index (approximate for PQ and scalar quantized indexes)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def entry_vectors(entry):
+    #Vectors of a cached index entry, exact when rescoring vectors are stored
+    if entry.get('vectors') is not None:
+        return np.asarray(entry['vectors'], dtype='float32')
+    return index_vectors(entry['index'])
+
+def index_embeddings(embeddings, ids, record_dict, file_name, index_type=None, precision=None):
+    # Every file of the index is written as a new generation, readers keep using the committed one until the switch
+    if not ids:
+        raise ValueError(f"No chunks to index for {file_name}, keeping its current index")
+    generation = next_generation(file_name)
+    stem = generation_stem(file_name, generation)
+    embeddings_array = normalize_rows(embeddings)  # Scores become cosine similarities
+    index = make_index(embeddings_array, index_type, precision)
+
+    # Compact indexes keep the exact vectors on disk for re-ranking
+    if index_precision(index) != "float32":
+        vectors_path = rescore_vectors_path(stem)
+        with open(vectors_path + ".tmp", 'wb') as f:
+            np.save(f, embeddings_array)
+        os.replace(vectors_path + ".tmp", vectors_path)
     
-    # Store all original metadata
-    metadata_store = {}
-    for i, id_ in enumerate(ids):
-        node = record_dict[id_]
-        metadata_store[id_] = {
-            'text': node.text,
-            'metadata': dict(node.metadata),
-            'faiss_index': i
-        }
-    
-    # Fix: Write index to file correctly
-    save_path = os.path.join(index_folder, f"{file_name}__index.faiss")  # Save path
-    faiss.write_index(index, save_path)  
-    
-    with open(os.path.join(index_folder, f"{file_name}__metadata.pkl"), 'wb') as f:
-        pickle.dump(metadata_store, f)
+    # Write chunk texts and original metadata, in FAISS order
+    nodes = [record_dict[id_] for id_ in ids]
+    write_chunk_store(stem, ids, [node.text for node in nodes], [dict(node.metadata) for node in nodes])
+    write_bm25_index(stem, [node.text for node in nodes])
+    write_index_file(index, index_paths(stem)[0])
+    commit_generation(file_name, generation)
+
+    # Replace any stale cached copy with the index that was just written
+    invalidate_index(file_name)
+    metadata_store = ChunkStore(stem)
+    cache_index(file_name, index, metadata_store, index_mtimes(stem), load_rescore_vectors(stem, index), stem)
     
     return index, metadata_store
 
-def query_faiss_index(embedding_model,file_base, query, top_k):
+def trim_results(results, min_score=None, margin=None):
+    #Drop weak hits before prompt construction: scores below min_score and, when margin is set (adaptive k),
+    #scores more than margin below the best hit. Only meaningful for cosine scores (dense retrieval).
+    min_score = default_min_score if min_score is None else min_score
+    margin = default_score_margin if margin is None else margin
+    if not results:
+        return results
+    cutoff = min_score
+    if margin > 0:
+        cutoff = max(cutoff, max(r['score'] for r in results) - margin)
+    kept = [r for r in results if r['score'] >= cutoff]
+    count('chunks_below_min_score', len(results) - len(kept))
+    return kept
+
+def estimate_tokens(text):
+    #Approximate token count, cheap enough to run on every prompt without a tokenizer round trip
+    return (len(text) + chars_per_token - 1) // chars_per_token
+
+def chunk_position(result):
+    #Position of a chunk within its file, taken from the {file}_{pos} id. None for other ids.
+    tail = str(result['id']).rsplit("_", 1)[-1]
+    return int(tail) if tail.isdigit() else None
+
+def merge_overlap(first, second, min_overlap=8):
+    #Join consecutive chunks, keeping the text they share (chunk_overlap) only once
+    for start in range(max(0, len(first) - len(second)), len(first) - min_overlap + 1):
+        if second.startswith(first[start:]):
+            return first + second[len(first) - start:]
+    return first + " " + second
+
+def pack_context(results, budget=None):
+    #Turn retrieved chunks into the passages of the conclusion prompt:
+    #1. consecutive chunks of the same page are merged into one passage (overlapping text written once),
+    #2. passages contained in a higher-scoring passage are dropped as duplicates,
+    #3. passages are taken best score first until the token budget is spent; the first one that does not
+    #   fit is cut at a word boundary, anything after it that does not fit is dropped.
+    #Merged passages keep the id and score of their best chunk. Returns (passages, stats).
+    budget = context_token_budget if budget is None else budget
+    stats = {'chunks': len(results), 'merged': 0, 'duplicates': 0, 'truncated': 0, 'dropped': 0}
+    groups, seen = {}, set()
+    for result in results:
+        if result['id'] in seen:  # Same chunk retrieved twice
+            stats['duplicates'] += 1
+            continue
+        seen.add(result['id'])
+        key = (result.get('metadata', {}).get('file_name'), result['page_number'])
+        groups.setdefault(key, []).append(result)
+    passages = []
+    for members in groups.values():
+        members.sort(key=lambda r: -1 if chunk_position(r) is None else chunk_position(r))
+        run = None
+        for result in members:
+            position = chunk_position(result)
+            if run is not None and position is not None and position == run['last'] + 1:
+                run['passage']['text'] = merge_overlap(run['passage']['text'], result['text'])
+                if result['score'] > run['passage']['score']:
+                    run['passage'].update(id=result['id'], score=result['score'])
+                run['last'] = position
+                stats['merged'] += 1
+            else:
+                run = {'passage': dict(result), 'last': position}
+                passages.append(run['passage'])
+
+    packed, used = [], 0
+    for passage in sorted(passages, key=lambda p: (-p['score'], -len(p['text']))):
+        if any(passage['text'] in kept['text'] for kept in packed):
+            stats['duplicates'] += 1
+            continue
+        tokens = estimate_tokens(passage['text'])
+        if used + tokens > budget:
+            remaining = budget - used
+            if remaining < min(min_passage_tokens, budget) or stats['truncated']:
+                stats['dropped'] += 1
+                continue
+            text = passage['text'][:remaining * chars_per_token - 3]  # Room for the ellipsis
+            text = text[:text.rfind(" ")] if " " in text else text
+            passage = dict(passage, text=text + "...")
+            tokens = estimate_tokens(passage['text'])
+            stats['truncated'] += 1
+        packed.append(passage)
+        used += tokens
+    stats.update(passages=len(packed), context_tokens=used)
+    for name in ('merged', 'duplicates', 'truncated', 'dropped'):
+        count(f'context_{name}', stats[name])
+    return packed, stats
+
+def build_result(entry, idx, score):
+    #Result dictionary for FAISS position idx of a cached index entry. Only this row is read from the store.
+    store = entry['store']
+    if 0 <= idx < len(store):
+        metadata = store.metadata(idx)
+        return {
+            'id': store.id(idx),
+            'text': store.text(idx),
+            'page_number': metadata.get('page_label', 
+                             metadata.get('page_number', 'N/A')),
+            'score': float(score),
+            'metadata': metadata  # All original metadata
+        }
+    return {
+        'id': f"missing_{idx}",
+        'text': f"Content not found for index {idx}",
+        'page_number': 'N/A',
+        'score': 0.0,
+        'metadata': {}
+    }
+
+def query_faiss_index(embedding_model,file_base, query, top_k, nprobe=None, ef_search=None, mode=None):
     #Query Faiss index given as input the base filename,query and the number of result to return.
     """
     Returns a list of dictionaries with complete metadata for each result
@@ -93,102 +1233,566 @@ def query_faiss_index(embedding_model,file_base, query, top_k):
         ...
     ]
     """
-    cwd = os.getcwd()  # Current working directory
-    index_folder = os.path.join(cwd, "indexed_pdfs")  # Folder where files are indexed
+    results = query_batch(embedding_model, file_base, [query], top_k, nprobe, ef_search, mode)
+    return results[0] if results else []
+
+def query_batch(embedding_model, file_base, queries, top_k, nprobe=None, ef_search=None, mode=None):
+    #Query one file's index with many queries: one encode pass and one FAISS search over the whole matrix.
+    #mode "hybrid" fuses the dense ranking with a BM25 ranking (reciprocal rank fusion); scores are then fused scores.
+    #Returns one query_faiss_index style result list per query, or [] on error.
     try:
-        # Load index and metadata
-        index = faiss.read_index(os.path.join(index_folder, f"{file_base}__index.faiss"))
-        with open(os.path.join(index_folder, f"{file_base}__metadata.pkl"), 'rb') as f:
-            metadata = pickle.load(f)
-        
-        # Create reverse mapping from FAISS index to ID
-        id_lookup = {v['faiss_index']: k for k, v in metadata.items()}
+        # Load index and metadata (served from the resident cache unless the files changed)
+        entry = load_index(file_base)
+        index = entry['index']
         
-        # Encode and search
-        query_embedding = embedding_model.encode([query]).astype('float32')
-        distances, indices = index.search(query_embedding, top_k)
+        # Encode, then search only the queries without a cached result for this index version
+        queries = list(queries)
+        query_embeddings = encode_queries(embedding_model, queries)
+        mode = mode or default_retrieval_mode
+        keys = [(file_base, entry['mtimes'], embedding_key(e), top_k, nprobe, ef_search, mode) for e in query_embeddings]
+        results = [result_cache.get(key) for key in keys]
+        missing = [q for q, r in enumerate(results) if r is None]
+        count('result_cache_hits', len(queries) - len(missing))
+        if missing:
+            depth = max(top_k, hybrid_depth) if mode == "hybrid" else top_k
+            with span('faiss_search', file=file_base, queries=len(missing), top_k=depth, index_size=index.ntotal):
+                distances, indices = search_index(entry, query_embeddings[missing], depth, nprobe, ef_search)
         
-        # Build results list
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if idx in id_lookup:
-                id_ = id_lookup[idx]
-                result_data = metadata[id_]
-                results.append({
-                    'id': id_,
-                    'text': result_data['text'],
-                    'page_number': result_data['metadata'].get('page_label', 
-                                     result_data['metadata'].get('page_number', 'N/A')),
-                    'score': float(distances[0][i]),
-                    'metadata': result_data['metadata']  # All original metadata
-                })
+            # Build results list
+            if mode == "hybrid":
+                bm25 = load_bm25(file_base, entry)
+                with span('bm25_search', file=file_base, queries=len(missing)):
+                    for row, q in enumerate(missing):
+                        lexical, _ = bm25.search(queries[q], depth)
+                        fused = rrf_fuse([indices[row][indices[row] >= 0], lexical], top_k)
+                        results[q] = [build_result(entry, idx, score) for idx, score in fused]
+                        result_cache.put(keys[q], results[q])
             else:
-                results.append({
-                    'id': f"missing_{idx}",
-                    'text': f"Content not found for index {idx}",
-                    'page_number': 'N/A',
-                    'score': 0.0,
-                    'metadata': {}
-                })
-        
+                for row, q in enumerate(missing):
+                    results[q] = [build_result(entry, idx, distances[row][i]) for i, idx in enumerate(indices[row])]
+                    result_cache.put(keys[q], results[q])
+        count('chunks_returned', sum(len(r) for r in results))
         return results
     
     except Exception as e:
         print(f"Error during query: {e}")
+        record_error('query', e)
         return []
       
 
-def index_folder(embedding_model,all_files, chunk_size, chunk_overlap):
-    # Index folder of pdf files
-    for file in all_files:
-        file_type = file.split(".")[-1]
-        if file_type.lower() == "pdf":
-            path = os.path.join(PDF, file)  # Path to PDF file                   
-            file_name = os.path.splitext(os.path.basename(path))[0]  # pdf filename
-
-            # 1. Load document
-            documents = llama_simple_reader(path)
-               
-            # 2. Chunk document
-            nodes, record_dict = chunk_documents(file_name, documents, path, chunk_size, chunk_overlap)
-              
-            # 3. Generate embeddings
+def indexed_files():
+    #Base names of every per-file index in indexed_pdfs/: committed generations plus unversioned indexes
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    if not os.path.isdir(index_folder):
+        return []
+    names = os.listdir(index_folder)
+    file_bases = {f[:-len("__current.json")] for f in names if f.endswith("__current.json")}
+    file_bases.update(f[:-len("__index.faiss")] for f in names
+                      if f.endswith("__index.faiss") and not f.startswith(corpus_name)
+                      and not re.search(r"__g\d+$", f[:-len("__index.faiss")]))
+    return sorted(file_bases)
+
+def corpus_paths():
+    #Corpus index, its ID map and the float32 vectors compact corpus indexes are re-ranked against
+    index_folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    return (os.path.join(index_folder, f"{corpus_name}.faiss"),
+            os.path.join(index_folder, f"{corpus_name}.json"),
+            os.path.join(index_folder, f"{corpus_name}.vectors.npy"))
+
+def corpus_signature(file_bases):
+    #Identifies the set of per-file indexes (file base, committed generation and file times) a corpus index was built from
+    signature = []
+    for file_base in file_bases:
+        stem = generation_stem(file_base)
+        signature.append([file_base, stem, *index_mtimes(stem)])
+    return signature
+
+def build_corpus_index(file_bases=None):
+    #Concatenate every per-file index into one corpus index with a global ID -> (file, position) map.
+    #The corpus index uses the configured index type and storage precision. Vectors are gathered into a
+    #memory-mapped file rather than RAM, kept for re-ranking when the index is compact.
+    file_bases = indexed_files() if file_bases is None else file_bases
+    signature = corpus_signature(file_bases)
+    settings = [default_index_type, default_precision]
+    entries = [load_index(file_base) for file_base in file_bases]
+    id_map, ranges = [], {}
+    for file_base, entry in zip(file_bases, entries):
+        rows = entry['index'].ntotal
+        ranges[file_base] = (len(id_map), len(id_map) + rows)
+        id_map.extend((file_base, i) for i in range(rows))
+
+    index_path, ids_path, vectors_path = corpus_paths()
+    vectors = np.lib.format.open_memmap(vectors_path + ".tmp", mode='w+', dtype='float32',
+                                        shape=(len(id_map), entries[0]['index'].d))
+    for file_base, entry in zip(file_bases, entries):
+        start, end = ranges[file_base]
+        vectors[start:end] = entry_vectors(entry)
+    vectors.flush()
+    index = make_index(vectors, *settings)
+    del vectors
+    if index_precision(index) == "float32":
+        os.remove(vectors_path + ".tmp")
+        vectors = None
+    else:
+        os.replace(vectors_path + ".tmp", vectors_path)
+        vectors = np.load(vectors_path, mmap_mode='r')
+
+    write_index_file(index, index_path)
+    with open(ids_path, "w") as f:
+        f.write(json.dumps({'signature': signature, 'settings': settings, 'ids': id_map, 'ranges': ranges}))
+    corpus_cache.update({'signature': signature, 'index': index, 'vectors': vectors, 'ids': id_map, 'ranges': ranges})
+    return corpus_cache
+
+def load_corpus_index():
+    #Return the corpus index, rebuilding it when any per-file index changed
+    with corpus_lock:
+        signature = corpus_signature(indexed_files())
+        if corpus_cache.get('signature') == signature:
+            return corpus_cache
+        index_path, ids_path, vectors_path = corpus_paths()
+        if os.path.isfile(index_path) and os.path.isfile(ids_path):
+            with open(ids_path, "r") as f:
+                stored = json.loads(f.read())
+            if stored['signature'] == signature and stored.get('settings') == [default_index_type, default_precision]:
+                index = read_index_file(index_path)
+                vectors = None
+                if index_precision(index) != "float32" and os.path.isfile(vectors_path):
+                    vectors = np.load(vectors_path, mmap_mode='r')
+                corpus_cache.update({'signature': signature, 'index': index, 'vectors': vectors,
+                                     'ids': [tuple(i) for i in stored['ids']],
+                                     'ranges': {k: tuple(v) for k, v in stored['ranges'].items()}})
+                return corpus_cache
+        with span('corpus_build'):
+            return build_corpus_index([s[0] for s in signature])
+
+def query_corpus(embedding_model, query, top_k, files=None):
+    #Search every indexed document with one FAISS search. files optionally limits the search to some file bases.
+    #Results use the query_faiss_index format plus a 'file' key.
+    results = query_corpus_batch(embedding_model, [query], top_k, files)
+    return results[0] if results else []
+
+def query_corpus_batch(embedding_model, queries, top_k, files=None):
+    #Batch version of query_corpus: one encode pass and one corpus search for all queries
+    try:
+        corpus = load_corpus_index()
+        selector = None
+        if files:
+            selected = np.concatenate([np.arange(*corpus['ranges'][f], dtype='int64') for f in files if f in corpus['ranges']] or [np.empty(0, dtype='int64')])
+            if selected.size == 0:
+                return [[] for _ in queries]
+            selector = faiss.IDSelectorBatch(selected)
+        queries = list(queries)
+        query_embeddings = encode_queries(embedding_model, queries)
+        version = tuple(tuple(item) for item in corpus['signature'])
+        keys = [(corpus_name, version, tuple(files or ()), embedding_key(e), top_k) for e in query_embeddings]
+        all_results = [result_cache.get(key) for key in keys]
+        missing = [q for q, r in enumerate(all_results) if r is None]
+        count('result_cache_hits', len(queries) - len(missing))
+        if missing:
+            with span('faiss_search', file=corpus_name, queries=len(missing), top_k=top_k, index_size=corpus['index'].ntotal):
+                # A filtered IVF search probes every list, the selected files may sit in lists a query would not probe
+                nprobe = corpus['index'].nlist if selector is not None and isinstance(corpus['index'], faiss.IndexIVF) else None
+                distances, indices = search_index(corpus, query_embeddings[missing], top_k, nprobe=nprobe, selector=selector)
+
+        for row, q in enumerate(missing):
+            results = []
+            for i, idx in enumerate(indices[row]):
+                if idx < 0:
+                    continue
+                file_base, local_idx = corpus['ids'][idx]
+                result = build_result(load_index(file_base), local_idx, distances[row][i])
+                result['file'] = file_base
+                results.append(result)
+            all_results[q] = results
+            result_cache.put(keys[q], results)
+        return all_results
+
+    except Exception as e:
+        print(f"Error during corpus query: {e}")
+        record_error('corpus_query', e)
+        return []
+
+def pdf_page_count(path):
+    #Number of pages, read from the PDF's page tree without extracting any text. 0 when pypdf is unavailable.
+    try:
+        import pypdf
+        return len(pypdf.PdfReader(path).pages)
+    except Exception as e:
+        print(f"Unable to count pages of {path}: {e}")
+        return 0
+
+def iter_pdf_pages(path, start=0):
+    #Yield one Document per page from start on, extracting text lazily so only the current page is held in memory.
+    #Metadata matches what SimpleDirectoryReader attaches to PDF pages.
+    import pypdf
+    from llama_index.core import Document
+    from llama_index.core.readers.file.base import default_file_metadata_func
+    reader = pypdf.PdfReader(path)
+    metadata = default_file_metadata_func(path)
+    labels = reader.page_labels  # Rebuilt for the whole document on every access, so read once
+    for number in range(start, len(reader.pages)):
+        text = reader.pages[number].extract_text() or ""
+        yield Document(text=text, metadata={'page_label': labels[number], **metadata})
+
+def ingest_paths(file_base):
+    #Checkpoint and partial files of an interrupted or running streaming ingestion
+    folder = os.path.join(os.getcwd(), "indexed_pdfs")
+    return {part: os.path.join(folder, f"{file_base}__ingest.{part}") for part in ('json', 'texts', 'offsets', 'meta', 'vectors')}
+
+def ingest_checkpoint(file_base, settings):
+    #Progress of an earlier run with identical settings, otherwise a fresh start
+    path = ingest_paths(file_base)['json']
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            checkpoint = json.loads(f.read())
+        if checkpoint.get('settings') == settings:
+            return checkpoint['progress']
+    return {'pages': 0, 'chunks': 0, 'text_bytes': 0, 'meta_bytes': 0}
+
+def append_ingest_batch(file_base, files, batch, embedding_model, settings, progress, pages):
+    #Embed one batch of (text, metadata) chunks, append it to the partial files and checkpoint after it
+    if batch:
+        # The process-wide embedding cache is bypassed, it would grow with the document
+        embeddings = normalize_rows(embed_texts([text for text, _ in batch], embedding_model, use_cache=False))
+        encoded = [text.encode('utf-8') for text, _ in batch]
+        ends = progress['text_bytes'] + np.cumsum([len(data) for data in encoded], dtype='int64')
+        meta = "".join(json.dumps(metadata, default=str, ensure_ascii=False) + "\n" for _, metadata in batch).encode('utf-8')
+        files['texts'].write(b"".join(encoded))
+        files['offsets'].write(ends.tobytes())
+        files['meta'].write(meta)
+        files['vectors'].write(embeddings.tobytes())
+        for f in files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        progress.update(chunks=progress['chunks'] + len(batch), text_bytes=int(ends[-1]),
+                        meta_bytes=progress['meta_bytes'] + len(meta))
+    progress['pages'] = pages
+    path = ingest_paths(file_base)['json']
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps({'settings': settings, 'progress': progress}))
+    os.replace(path + ".tmp", path)
+
+def ingest_pdf(file_name, path, chunk_size, chunk_overlap, embedding_model, index_type=None, precision=None):
+    #Index a large PDF page by page. Pages are read and chunked one at a time, and every stream_batch_chunks
+    #chunks are embedded (without the embedding cache) and appended to partial chunk store and vector files
+    #followed by a checkpoint, so memory while reading and embedding is bounded by the batch size. A crashed
+    #run with the same content and settings resumes after its last checkpoint. The FAISS, chunk and BM25
+    #indexes are built from the partial files (vectors memory-mapped) once every page is in; that final step
+    #holds the index and the BM25 postings, which grow with the document. Returns the number of chunks.
+    from llama_index.core.node_parser import SimpleNodeParser
+    paths = ingest_paths(file_name)
+    settings = {'sha256': file_fingerprint(path)['sha256'], 'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap,
+                'model': embedding_model_name}
+    progress = ingest_checkpoint(file_name, settings)
+    if progress['pages']:
+        print(f"Resuming {file_name} at page {progress['pages'] + 1} ({progress['chunks']} chunks already embedded)")
+    dimension = embedding_model.get_sentence_embedding_dimension()
+    sizes = {'texts': progress['text_bytes'], 'offsets': progress['chunks'] * 8, 'meta': progress['meta_bytes'],
+             'vectors': progress['chunks'] * dimension * 4}
+    files = {part: open(paths[part], 'ab') for part in sizes}
+    try:
+        for part, f in files.items():
+            f.truncate(sizes[part])  # Drop anything written after the last checkpoint
+        parser = SimpleNodeParser.from_defaults(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        batch, pages = [], progress['pages']
+        for document in iter_pdf_pages(path, pages):
+            batch.extend((node.text, dict(node.metadata)) for node in parser.get_nodes_from_documents([document]))
+            pages += 1
+            if len(batch) >= stream_batch_chunks:
+                append_ingest_batch(file_name, files, batch, embedding_model, settings, progress, pages)
+                batch = []
+        append_ingest_batch(file_name, files, batch, embedding_model, settings, progress, pages)
+    finally:
+        for f in files.values():
+            f.close()
+
+    chunks = progress['chunks']
+    if chunks:
+        generation = next_generation(file_name)
+        stem = generation_stem(file_name, generation)
+        vectors = np.memmap(paths['vectors'], dtype='float32', mode='r', shape=(chunks, dimension))
+        index = make_index(vectors, index_type, precision)
+        texts_path, offsets_path, _ = chunk_store_paths(stem)
+        os.replace(paths['texts'], texts_path)
+        offsets = np.concatenate([[0], np.fromfile(paths['offsets'], dtype='int64')])
+        with open(offsets_path + ".tmp", 'wb') as f:
+            np.save(f, offsets)
+        os.replace(offsets_path + ".tmp", offsets_path)
+        with open(paths['meta'], "r", encoding="utf-8") as f:
+            id_base = file_name.replace("-", "_")
+            write_chunk_table(stem, [f"{id_base}_{pos}" for pos in range(chunks)], (json.loads(line) for line in f))
+        store = ChunkStore(stem)
+        write_bm25_index(stem, (store.text(pos) for pos in range(chunks)))
+
+        # Compact indexes keep the exact vectors on disk for re-ranking, copied in slices
+        if index_precision(index) != "float32":
+            vectors_path = rescore_vectors_path(stem)
+            exact = np.lib.format.open_memmap(vectors_path + ".tmp", mode='w+', dtype='float32', shape=vectors.shape)
+            for start in range(0, chunks, stream_batch_chunks):
+                exact[start:start + stream_batch_chunks] = vectors[start:start + stream_batch_chunks]
+            exact.flush()
+            del exact
+            os.replace(vectors_path + ".tmp", vectors_path)
+        del vectors
+        write_index_file(index, index_paths(stem)[0])
+        commit_generation(file_name, generation)
+
+        invalidate_index(file_name)
+        cache_index(file_name, index, store, index_mtimes(stem), load_rescore_vectors(stem, index), stem)
+        update_manifest(file_name, path, chunk_size, chunk_overlap, chunks, index_type, index, precision)
+    for part_path in paths.values():
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+    if not chunks:
+        raise ValueError(f"No text extracted from {path}, keeping the current index of {file_name}")
+    print(f"Streamed {file_name}: {progress['pages']} pages, {chunks} chunks")
+    return chunks
+
+def run_with_timeout(seconds, function, *args):
+    #Call function, raising TimeoutError inside it after seconds. Uses SIGALRM, so the limit applies on the
+    #main thread of a process (as in the extraction workers) on platforms that have it, not on Windows.
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return function(*args)
+    def expire(signum, frame):
+        raise TimeoutError(f"gave up after {seconds:.0f}s")
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return function(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def init_extraction_worker():
+    #Import the parsing libraries once per worker process, so their import time does not count against a file's timeout
+    from llama_index.core import Document, SimpleDirectoryReader
+    from llama_index.core.node_parser import SimpleNodeParser
+
+def parse_and_chunk(path, chunk_size, chunk_overlap, timeout=None):
+    #Extract and chunk a single file. Runs inside a worker process of index_folder, where a file
+    #taking longer than timeout seconds is abandoned (TimeoutError) and the worker moves on.
+    #A file that yields no chunks (unreadable, encrypted or empty) fails with ValueError.
+    file_name = os.path.splitext(os.path.basename(path))[0]  # source filename
+    stages = {'format': source_format(path), 'bytes': os.path.getsize(path)}
+
+    def extract():
+        start = time.perf_counter()
+        documents = extract_documents(path)
+        stages['read'] = time.perf_counter() - start
+        nodes, record_dict = chunk_documents(file_name, documents, path, chunk_size, chunk_overlap)
+        stages['chunk'] = time.perf_counter() - start - stages['read']
+        return record_dict
+
+    record_dict = run_with_timeout(timeout, extract)
+    if not record_dict:
+        raise ValueError(f"no text extracted from {path}")
+    stages['chunks'] = len(record_dict)
+    return file_name, path, record_dict, stages
+
+def format_throughput(timings):
+    #Files, chunks, bytes and stage seconds per source format of an index_folder run. Extraction runs in
+    #parallel, so the stage seconds add up worker time rather than wall-clock time.
+    formats = {}
+    for stages in timings.values():
+        row = formats.setdefault(stages.get('format', '?'), {'files': 0, 'failed': 0, 'chunks': 0, 'bytes': 0, 'seconds': 0.0})
+        row['files'] += 1
+        row['failed'] += 'error' in stages
+        row['chunks'] += stages.get('chunks', 0)
+        row['bytes'] += stages.get('bytes', 0)
+        row['seconds'] += sum(stages.get(stage, 0.0) for stage in ('read', 'chunk', 'embed', 'write', 'stream'))
+    for row in formats.values():
+        seconds = row['seconds'] or float('inf')
+        row.update(files_per_sec=row['files'] / seconds, chunks_per_sec=row['chunks'] / seconds,
+                   mb_per_sec=row['bytes'] / 1e6 / seconds)
+    return formats
+
+def embedding_worker(work_queue, embedding_model, timings, chunk_size, chunk_overlap, index_type=None):
+    #Consume chunked files from the queue, embed them and write their indexes
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        file_name, path, record_dict, stages = item
+        try:
+            start = time.perf_counter()
             embeddings, ids = embed_record_dict(record_dict, embedding_model)
-                 
-            # 4. Create index
-            index, metadata_store = index_embeddings(embeddings, ids, record_dict, file_name)
+            stages['embed'] = time.perf_counter() - start
+            start = time.perf_counter()
+            index, metadata_store = index_embeddings(embeddings, ids, record_dict, file_name, index_type)
+            update_manifest(file_name, path, chunk_size, chunk_overlap, len(ids), index_type, index)
+            stages['write'] = time.perf_counter() - start
+        except Exception as e:
+            print(f"Unable to index {file_name}: {e}")
+            stages['error'] = str(e)
+        timings[file_name] = stages
 
-# Function to re-index a PDF file
-def reindex_pdf(file_name, chunk_size, chunk_overlap,embedding_model):
-    """
-    Function to re-index a single PDF file with the specified chunk size and overlap.
-    """
-    pdf_folder = os.path.join(os.getcwd(), "PDF")
-    file_path = os.path.join(pdf_folder, f"{file_name}.pdf")
+def index_folder(embedding_model,all_files, chunk_size, chunk_overlap, workers=None, force=False, index_type=None):
+    # Index folder of source files of any format in the extractors registry.
+    # Worker processes extract and chunk files in parallel (each limited to extract_timeout seconds)
+    # while a single thread embeds and
+    # writes each file as it arrives. The bounded queue keeps parsed files from piling up
+    # faster than they can be embedded. Files already indexed from the same content and
+    # settings are skipped unless force is set. PDFs above stream_ingest_pages pages are streamed
+    # afterwards with ingest_pdf instead of being parsed whole. Returns per-file stage timings in seconds.
+    paths = [os.path.join(PDF, file) for file in all_files if source_format(file) in extractors]
+    # Indexes and the manifest are keyed by base name, so a base name with more than one source is skipped
+    names = {p: os.path.splitext(os.path.basename(p))[0] for p in paths}
+    bases = Counter(names.values())
+    shared = set(shared_source_bases()) | {base for base, n in bases.items() if n > 1}
+    for base in sorted(shared & set(bases)):
+        print(f"Not indexing {base}: the name is shared by several source files, rename all but one")
+    paths = [p for p in paths if names[p] not in shared]
+    if not force:
+        manifest = load_manifest()
+        current = [p for p in paths if is_index_current(os.path.splitext(os.path.basename(p))[0], p, chunk_size, chunk_overlap, manifest, index_type)]
+        if current:
+            print(f"Skipping {len(current)} unchanged files")
+        paths = [p for p in paths if p not in current]
+    timings = {}
+    if not paths:
+        return timings
+    large = [p for p in paths if source_format(p) == "pdf" and (os.path.isfile(ingest_paths(os.path.splitext(os.path.basename(p))[0])['json'])
+                                                                or pdf_page_count(p) > stream_ingest_pages)]
+    paths = [p for p in paths if p not in large]
+
+    work_queue = queue.Queue(maxsize=index_queue_size)
+    embedder = threading.Thread(target=embedding_worker, args=(work_queue, embedding_model, timings, chunk_size, chunk_overlap, index_type))
+    embedder.start()
+    start = time.perf_counter()
+    try:
+        if paths:
+            with ProcessPoolExecutor(max_workers=min(workers or index_workers, len(paths)), initializer=init_extraction_worker) as pool:
+                futures = {pool.submit(parse_and_chunk, path, chunk_size, chunk_overlap, extract_timeout): path for path in paths}
+                for future in as_completed(futures):
+                    try:
+                        work_queue.put(future.result())  # Blocks while the embedding worker is behind
+                    except Exception as e:
+                        path = futures[future]
+                        print(f"Unable to chunk {path}: {e!r}")
+                        timings[os.path.splitext(os.path.basename(path))[0]] = {
+                            'format': source_format(path), 'bytes': os.path.getsize(path), 'error': repr(e)}
+    finally:
+        work_queue.put(None)
+        embedder.join()
+    try:
+        for path in large:
+            file_name = os.path.splitext(os.path.basename(path))[0]
+            stage_start = time.perf_counter()
+            try:
+                chunks = ingest_pdf(file_name, path, chunk_size, chunk_overlap, embedding_model, index_type)
+                timings[file_name] = {'format': 'pdf', 'bytes': os.path.getsize(path),
+                                      'stream': time.perf_counter() - stage_start, 'chunks': chunks}
+            except Exception as e:
+                print(f"Unable to index {file_name}: {e}")
+                timings[file_name] = {'format': 'pdf', 'bytes': os.path.getsize(path), 'error': str(e)}
+    finally:
+        save_embedding_cache()
+
+    total = time.perf_counter() - start
+    for stage in ('read', 'chunk', 'embed', 'write', 'stream'):
+        stage_time = sum(t.get(stage, 0.0) for t in timings.values())
+        print(f"{stage}: {stage_time:.2f}s")
+    for name, row in sorted(format_throughput(timings).items()):
+        print(f"{name}: {row['files']} files ({row['failed']} failed), {row['chunks']} chunks, {row['bytes'] / 1e6:.1f} MB, "
+              f"{row['files_per_sec']:.2f} files/s, {row['chunks_per_sec']:.0f} chunks/s, {row['mb_per_sec']:.2f} MB/s")
+    print(f"Indexed {len(timings)} files in {total:.2f}s")
+    return timings
+
+def reindex_file(file_name, chunk_size, chunk_overlap, embedding_model, force=False, index_type=None):
+    #Re-index one source file (any registered format) from the PDF folder. Returns False when it was
+    #already current and nothing was rebuilt.
+    file_path = source_path(file_name)
+
+    if not force and is_index_current(file_name, file_path, chunk_size, chunk_overlap, index_type=index_type):
+        return False
+
+    # Large PDFs (or one with an interrupted ingestion) are streamed page by page
+    if source_format(file_path) == "pdf" and (os.path.isfile(ingest_paths(file_name)['json'])
+                                              or pdf_page_count(file_path) > stream_ingest_pages):
+        ingest_pdf(file_name, file_path, chunk_size, chunk_overlap, embedding_model, index_type)
+        return True
     
     # Re-index the file
-    documents = llama_simple_reader(file_path)
+    documents = extract_documents(file_path)
     
     # Chunk the document
     nodes, record_dict = chunk_documents(file_name, documents, file_path, chunk_size, chunk_overlap)
     
     # Generate embeddings and create the index
     embeddings, ids = embed_record_dict(record_dict, embedding_model)
-    index, metadata_store = index_embeddings(embeddings, ids, record_dict, file_name)
+    index, metadata_store = index_embeddings(embeddings, ids, record_dict, file_name, index_type)
+    update_manifest(file_name, file_path, chunk_size, chunk_overlap, len(ids), index_type, index)
+    save_embedding_cache()
+    return True
 
-    # Display a success message
-    st.success(f"Re-indexed {file_name}.pdf with chunk size {chunk_size} and chunk overlap {chunk_overlap}.")
+# Function to re-index a PDF file
+def reindex_pdf(file_name, chunk_size, chunk_overlap,embedding_model, force=False, index_type=None):
+    """
+    Function to re-index a single PDF file with the specified chunk size and overlap.
+    Nothing is rebuilt when the file is unchanged and already indexed with these settings.
+    """
+    source_name = os.path.basename(source_path(file_name))
+    try:
+        reindexed = reindex_file(file_name, chunk_size, chunk_overlap, embedding_model, force, index_type)
+    except ValueError as e:
+        st.error(f"Unable to re-index {source_name}: {e}")
+        return
+    if reindexed:
+        # Display a success message
+        st.success(f"Re-indexed {source_name} with chunk size {chunk_size} and chunk overlap {chunk_overlap}.")
+    else:
+        st.info(f"{source_name} is already indexed with chunk size {chunk_size} and chunk overlap {chunk_overlap}.")
+
+
+def service_request(method, path, payload=None):
+    #Call the retrieval service, reusing idle keep-alive connections. Retries once on a dropped connection.
+    import http.client
+    from urllib.parse import urlsplit
+    url = urlsplit(retrieval_service_url)
+    for attempt in range(2):
+        try:
+            conn = service_connections.get_nowait()
+        except queue.Empty:
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=retrieval_service_timeout)
+        try:
+            body = json.dumps(payload) if payload is not None else None
+            conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"{}")
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if attempt:
+                raise
+            continue
+        service_connections.put(conn)
+        if response.status != 200:
+            raise RuntimeError(data.get("error", f"HTTP {response.status}"))
+        return data
 
+def remote_search(query, top_k, file=None, files=(), mode=None):
+    #query_faiss_index / query_corpus through the retrieval service
+    try:
+        payload = {"query": query, "top_k": top_k, "file": file, "files": list(files), "mode": mode}
+        return service_request("POST", "/search", payload)["results"]
+    except Exception as e:
+        print(f"Error during remote query: {e}")
+        record_error('remote_query', e)
+        return []
+
+def remote_reindex(file_name, chunk_size, chunk_overlap, force=False, index_type=None):
+    #reindex_file through the retrieval service
+    payload = {"file": file_name, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap,
+               "force": force, "index_type": index_type}
+    return service_request("POST", "/reindex", payload)["reindexed"]
 
 def chunk_stats(chunk_path,PDF):
     #Get chunk stats for each file and return to UI    
     #Initial/default chunk and overlap
     if not os.path.isfile(chunk_path):
         stats_dict={}
-        all_pdfs=os.listdir(PDF)#List of pdf files
+        all_pdfs=os.listdir(PDF)#List of source files
         for file in all_pdfs:
-            file_type=file.split(".")[-1]#File type
-            if file_type.lower()=="pdf":
+            if source_format(file) in extractors:
                 stats_dict[file]={"chunk":512,"overlap":50}
         viewJson=json.dumps(stats_dict,indent=2,ensure_ascii=False)
         with open(chunk_path,"w") as f:
@@ -200,27 +1804,181 @@ def chunk_stats(chunk_path,PDF):
     return stats_dict
 
         
+def get_llm_client():
+    #Create the Gemini client once and reuse it (and its connection pool) for every call
+    with llm_lock:
+        if llm_state['client'] is None:
+            from google import genai
+            api_key = my_key or os.environ.get("GEMINI_API_KEY", "")
+            #api_key = st.secrets["API_KEY"]#Use when running on cloud
+            http_options = {'base_url': llm_base_url} if llm_base_url else None
+            llm_state['client'] = genai.Client(api_key=api_key, http_options=http_options)
+        return llm_state['client']
+
+def get_llm_loop():
+    #Background event loop for async LLM calls. One long-lived loop lets the async client keep its connections.
+    with llm_lock:
+        if llm_state['loop'] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            llm_state['loop'] = loop
+        return llm_state['loop']
+
 def query_gemini(task):
     # Query LLM. Takes as input the task definitiion and returns the LLM response.
     query_state = ""
     TEXT = ""
-    model_name="gemini-2.0-flash"
+    model_name=llm_model_name
+    prompt_key = hashlib.sha256(f"{model_name}\n{task}".encode('utf-8')).hexdigest()
+    cached = llm_cache.get(prompt_key)
+    if cached is not None:
+        return cached, query_state
     try:
-        # Pass the API key directly as a string, not as a dictionary
-        client = genai.Client(api_key=my_key)#Only when running app on your local machine
-        
-        #client = genai.Client(api_key=st.secrets["API_KEY"])#Use when running on cloud
-
-        response = client.models.generate_content(
-            model=model_name, contents=task
-        )
+        client = get_llm_client()
+        with span('llm_call', prompt_chars=len(task)):
+            response = client.models.generate_content(
+                model=model_name, contents=task
+            )
         TEXT = str(response.text)
+        llm_cache.put(prompt_key, TEXT)
         # st.text(f"LLM:{TEXT}")
     except Exception as e:
         st.write(f"Unable to query llm. Please check network connection:  {e}")
+        record_error('llm_call', e)
         query_state = "error"
     return TEXT, query_state
 
+async def query_gemini_async(task, semaphore):
+    #Async LLM call with a concurrency limit, per-attempt timeout and retries with backoff.
+    #Returns (TEXT, query_state) like query_gemini.
+    prompt_key = hashlib.sha256(f"{llm_model_name}\n{task}".encode('utf-8')).hexdigest()
+    cached = llm_cache.get(prompt_key)
+    if cached is not None:
+        return cached, ""
+    client = get_llm_client()
+    for attempt in range(llm_retries + 1):
+        try:
+            async with semaphore:
+                response = await asyncio.wait_for(
+                    client.aio.models.generate_content(model=llm_model_name, contents=task), llm_timeout)
+            TEXT = str(response.text)
+            llm_cache.put(prompt_key, TEXT)
+            return TEXT, ""
+        except Exception as e:
+            if attempt == llm_retries:
+                print(f"LLM call failed after {attempt + 1} attempts: {e!r}")
+                return "", "error"
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+def gemini_stream(task):
+    #Yield the Gemini response to task as text pieces while it is generated
+    client = get_llm_client()
+    for chunk in client.models.generate_content_stream(model=llm_model_name, contents=task):
+        if chunk.text:
+            yield chunk.text
+
+def fake_stream(task):
+    #Offline backend: streams a fixed well-formed answer a few characters at a time
+    response = '```{"ANSWER":"This is a placeholder summary produced by the fake LLM backend.","JUSTIFICATION":[]}```'
+    for pos in range(0, len(response), 4):
+        time.sleep(fake_llm_delay)
+        yield response[pos:pos + 4]
+
+llm_backends={'gemini': gemini_stream, 'fake': fake_stream}#name -> generator of response text pieces
+
+def stream_llm(task, sink):
+    #Stream the response to task from the configured backend, appending every piece to sink.
+    #Complete responses are cached like query_gemini, and a cached response is replayed in one piece.
+    prompt_key = hashlib.sha256(f"{llm_model_name}\n{task}".encode('utf-8')).hexdigest()
+    cached = llm_cache.get(prompt_key)
+    if cached is not None:
+        sink.append(cached)
+        yield cached
+        return
+    for piece in llm_backends[llm_backend](task):
+        sink.append(piece)
+        yield piece
+    llm_cache.put(prompt_key, "".join(sink))
+
+class AnswerStreamParser:
+    #Incrementally extracts the ANSWER text from a partially received
+    #{"ANSWER": "...", "JUSTIFICATION": [...]} response. Each character is scanned once.
+    answer_key = re.compile(r'"ANSWER"\s*:\s*\[?\s*(["\'])')
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0  # Next unscanned position inside the answer string
+        self.quote = None  # Quote character that closes the answer string
+        self.done = False
+
+    def feed(self, piece):
+        #Add a piece of response text and return the answer text it completed (possibly "")
+        self.buffer += piece
+        if self.done:
+            return ""
+        if self.quote is None:
+            match = self.answer_key.search(self.buffer)
+            if match is None:
+                return ""
+            self.quote = match.group(1)
+            self.pos = match.end()
+        out = []
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if char == "\\":
+                if self.pos + 1 >= len(self.buffer):
+                    break  # Wait for the escaped character
+                out.append(self.buffer[self.pos + 1])
+                self.pos += 2
+                continue
+            if char == self.quote:
+                self.done = True
+                break
+            out.append(char)
+            self.pos += 1
+        return "".join(out)
+
+def stream_answer(task, sink):
+    #Yield only the ANSWER text of the streamed response, for st.write_stream
+    parser = AnswerStreamParser()
+    for piece in stream_llm(task, sink):
+        text = parser.feed(piece)
+        if text:
+            yield text
+
+def is_relevant(out):
+    #Read the YES/NO verdict of a build_prompt response
+    try:
+        answer = json_repair.loads(parse_llm(out)).get("ANSWER")
+    except Exception:
+        return None
+    if isinstance(answer, list):
+        answer = answer[0] if answer else ""
+    answer = str(answer).strip().upper()
+    if answer.startswith("YES"):
+        return True
+    if answer.startswith("NO"):
+        return False
+    return None
+
+async def check_relevance(expert, question, results):
+    semaphore = asyncio.Semaphore(llm_concurrency)
+    tasks = [query_gemini_async(build_prompt(expert, result['text'], question), semaphore) for result in results]
+    return await asyncio.gather(*tasks)
+
+def filter_relevant(expert, question, results):
+    #Ask the LLM whether each retrieved chunk supports the question, all chunks in parallel,
+    #and keep the ones it does not reject. Chunks whose check failed are kept.
+    if not results:
+        return results
+    future = asyncio.run_coroutine_threadsafe(check_relevance(expert, question, results), get_llm_loop())
+    responses = future.result()
+    kept = []
+    for result, (out, state) in zip(results, responses):
+        if state == "error" or is_relevant(out) is not False:
+            kept.append(result)
+    return kept
+
 def build_prompt(expert, verses,question):
     task = f"""{expert} who has been given the following task:
              Based on the following question:
@@ -289,15 +2047,16 @@ def parse_llm(out):
         json_string = out[start:end+1]
     return json_string
 
-def display_results(out2,text_dict):
-    # Display the parsed query results
+def display_results(out2,text_dict, show_summary=True):
+    # Display the parsed query results. show_summary=False when the summary was already streamed.
     page = ""
     score = 0
     ID=""
     text =""
     try:
         #pydict = json.loads(out2)  # Return dictionary
-        pydict= json_repair.loads(out2)#Try and repair any broken json from LLM.
+        with span('json_repair', chars=len(out2)):
+            pydict= json_repair.loads(out2)#Try and repair any broken json from LLM.
         with st.expander("JSON Output"):
             st.write(pydict)
         summary = pydict.get("ANSWER")
@@ -306,9 +2065,11 @@ def display_results(out2,text_dict):
 
         # Summary
         if summary!=None:
-            st.write("**AI Summary**")
+            if show_summary:
+                st.write("**AI Summary**")
             if isinstance(summary,str):
-                st.write(summary)
+                if show_summary:
+                    st.write(summary)
                 st.write("---")  # Horizontal line for separation
                 
                 # Supporting documents    
@@ -316,11 +2077,11 @@ def display_results(out2,text_dict):
                     st.write("**Supporting Records**")
                     for doc in justification:
                         #st.write(f"DOC:{doc}")
-                        doc_metadata = doc.split("-")
+                        doc_metadata = re.match(r"(.*?)-(-?[0-9.]+(?:e-?[0-9]+)?)-([^-]+)-", doc)  # page-score-ID-text, score may be negative
                         #st.write(doc_metadata)
-                        page = doc_metadata[0]
-                        score = round((float(doc_metadata[1])), 2)
-                        ID=str(doc_metadata[2])
+                        page = doc_metadata.group(1)
+                        score = round((float(doc_metadata.group(2))), 2)
+                        ID=str(doc_metadata.group(3))
                         #st.write(f"ID: {ID}")
                         text =text_dict[ID]#Get original text
                 
@@ -331,25 +2092,30 @@ def display_results(out2,text_dict):
         
                     
             #Summary not available    
-            if isinstance(summary,list):
+            if isinstance(summary,list) and show_summary:
                 st.write(summary[0])
             
             
     except Exception as e:
         pydict = {}
+        record_error('display_results', e)
         #st.write(f"Error: {str(e)}")
     
 
 # Streamlit UI
 def main():
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')#Embedding model
+    if model_warmup and not retrieval_service_url:
+        warm_up_model()  # Embedding model loads in the background while the page renders
     stats_dict=chunk_stats(chunk_file,PDF)
-    # List all PDF files in the 'PDF' folder
-    pdf_folder = os.path.join(os.getcwd(), "PDF")
-    all_files = [f[:-4] for f in os.listdir(pdf_folder) if f.endswith(".pdf")]
+    # List all source files in the 'PDF' folder
+    all_files = source_files()
+    for base, files in shared_source_bases().items():
+        st.sidebar.warning(f"{', '.join(files)} share the name {base} and are not indexed, rename all but one")
 
     # Sidebar: File selection, chunk size, and chunk overlap inputs
     st.sidebar.header("Re-index PDF File")
+    if not embedding_model_state['warm'] and not retrieval_service_url:
+        st.sidebar.caption("Embedding model is loading in the background...")
     
     # File selection dropdown
     selected_file = st.sidebar.selectbox("Choose a file to re-index", all_files)
@@ -357,26 +2123,60 @@ def main():
     # Chunk size and overlap sliders
     chunk_size = st.sidebar.slider("Choose chunk size", min_value=128, max_value=1024, value=512, step=128)
     chunk_overlap = st.sidebar.slider("Choose chunk overlap", min_value=0, max_value=100, value=50, step=10)
+    index_type = st.sidebar.selectbox("Index type", index_types, index=index_types.index(default_index_type) if default_index_type in index_types else 0)
+    retrieval_mode = st.sidebar.selectbox("Retrieval mode", retrieval_modes, index=retrieval_modes.index(default_retrieval_mode) if default_retrieval_mode in retrieval_modes else 0,
+                                          help="hybrid fuses semantic search with BM25 keyword search (single document only)")
 
     #Number of results to return
     top_k = st.sidebar.slider("Number of documents to return", min_value=1, max_value=20, value=5)
+    min_score = st.sidebar.slider("Minimum similarity", min_value=0.0, max_value=1.0, value=default_min_score, step=0.05,
+                                  help="Passages with a lower cosine similarity are not sent to the LLM")
+    score_margin = st.sidebar.slider("Adaptive k margin", min_value=0.0, max_value=1.0, value=default_score_margin, step=0.05,
+                                     help="Keep only passages within this similarity of the best one (0 = off)")
+    token_budget = st.sidebar.slider("Context token budget", min_value=250, max_value=8000, value=context_token_budget, step=250,
+                                     help="Estimated tokens of passage text sent to the LLM for the summary")
+
+    #Search scope: the selected file or the whole library
+    stream_answer_mode = st.sidebar.checkbox("Stream the AI summary", value=True)
+    relevance_gate = st.sidebar.checkbox("Filter retrieved chunks with the LLM", value=True)
+    search_all = st.sidebar.checkbox("Search all documents", value=False)
+    search_files = []
+    if search_all:
+        search_files = st.sidebar.multiselect("Limit search to", service_request("GET", "/files")["files"] if retrieval_service_url else indexed_files())
      
     # Show full stats table in sidebar
     st.sidebar.subheader("📊 Indexing Stats")
-    stats_df = pd.DataFrame.from_dict(stats_dict, orient="index")
+    stats_df = pd.DataFrame.from_dict(stats_dict, orient="index", columns=["chunk", "overlap"])
     stats_df.index.name = "File"
     stats_df.columns = ["Chunk Size", "Overlap"]
     st.sidebar.dataframe(stats_df)    
 
+    with st.sidebar.expander("Cache statistics"):
+        st.write(cache_stats())
+
+    if st.sidebar.checkbox("Show request traces", value=False):
+        rows = trace_rows()
+        if rows:
+            st.sidebar.dataframe(pd.DataFrame(rows).set_index("request"))
+        else:
+            st.sidebar.caption("No requests traced yet.")
+
     # Re-index button
-    if st.sidebar.button(f"Re-index {selected_file}.pdf"):
-        original_filename=f"{selected_file}.pdf"
-        reindex_pdf(selected_file, chunk_size, chunk_overlap,embedding_model)
+    original_filename=os.path.basename(source_path(selected_file))
+    if st.sidebar.button(f"Re-index {original_filename}"):
+        if retrieval_service_url:
+            if remote_reindex(selected_file, chunk_size, chunk_overlap, index_type=index_type):
+                st.success(f"Re-indexed {original_filename} with chunk size {chunk_size} and chunk overlap {chunk_overlap}.")
+            else:
+                st.info(f"{original_filename} is already indexed with chunk size {chunk_size} and chunk overlap {chunk_overlap}.")
+        else:
+            reindex_pdf(selected_file, chunk_size, chunk_overlap,get_embedding_model(), index_type=index_type)
         stats_dict[original_filename]={"chunk":chunk_size,"overlap":chunk_overlap}
         viewJson=json.dumps(stats_dict,indent=2,ensure_ascii=False)
-        #Save updated chunk metadata
-        with open("chunk_stats.json","w") as f:
+        #Save updated chunk metadata (replaced, so a concurrent session never reads a half-written file)
+        with open(chunk_file + ".tmp","w") as f:
             f.write(viewJson)
+        os.replace(chunk_file + ".tmp", chunk_file)
         
 
     # Query section (optional, depending on the rest of your UI)
@@ -384,34 +2184,119 @@ def main():
     query = st.text_input("Enter your query:")
     
     if query:
-        final_list=[]
-        text_dict={}
-        # Here you can call the query function with the selected file
-        st.write(f"Querying {selected_file}.pdf with your input: {query}")
-        results = query_faiss_index(embedding_model,selected_file,query, top_k) #file_base: str, query: str, top_k: int = 5
-        #st.write(results[0])
-        
-        #Display results
-        #Loop thru each result
-        for result in results:
-            ID=result["id"]            #Document ID
-            answer=result['text'] #Text from record
-            score=result['score']                #Confidence score for match
-            page=result["page_number"] #Match page number
-            text_dict[ID]=answer                #Stores original text in dictionary
+        with trace_request("query", file="*" if search_all else selected_file, top_k=top_k):
+            embedding_model = None if retrieval_service_url else get_embedding_model()  # Blocks only until the shared model has loaded
+            final_list=[]
+            text_dict={}
+
+            #Paraphrases of an already answered question are served from the semantic answer cache
+            scope = None
+            if not retrieval_service_url:
+                with span('answer_cache_lookup'):
+                    query_embedding = encode_queries(embedding_model, [query])[0]
+                    scope = answer_scope(None if search_all else selected_file, search_files,
+                                         (top_k, retrieval_mode, min_score, score_margin, token_budget, relevance_gate))
+                    cached = answer_cache.get(scope, query_embedding) if scope is not None else None
+                if cached is not None:
+                    answer, cached_query, similarity = cached
+                    count('answer_cache_hits')
+                    st.caption(f"Answered from cache: similar to \"{cached_query}\" (similarity {similarity:.2f})")
+                    display_results(answer['out'], answer['text_dict'])
+                    return
+
+            # Here you can call the query function with the selected file
+            if search_all:
+                st.write(f"Querying all documents with your input: {query}")
+                if retrieval_service_url:
+                    results = remote_search(query, top_k, None, search_files)
+                else:
+                    results = query_corpus(embedding_model, query, top_k, search_files)
+            else:
+                st.write(f"Querying {os.path.basename(source_path(selected_file))} with your input: {query}")
+                if retrieval_service_url:
+                    results = remote_search(query, top_k, selected_file, mode=retrieval_mode)
+                else:
+                    results = query_faiss_index(embedding_model,selected_file,query, top_k, mode=retrieval_mode) #file_base: str, query: str, top_k: int = 5
+            #st.write(results[0])
+
+            #Drop weak hits (cosine scores only, hybrid scores are rank based)
+            if search_all or retrieval_mode == "dense":
+                retrieved = len(results)
+                results = trim_results(results, min_score, score_margin)
+                if len(results) < retrieved:
+                    st.caption(f"{retrieved - len(results)} of {retrieved} retrieved passages dropped below the similarity cut-off")
+                if retrieved and not results:
+                    st.write("No passage is similar enough to the question. Try lowering the minimum similarity.")
+                    return
+
+            #Show the retrieved passages straight away, before any LLM call
+            with st.expander(f"Retrieved passages ({len(results)})"):
+                for result in results:
+                    st.write(f"**Page {result['page_number']}** (score {result['score']:.2f}) {result['text'][:200]}...")
             expert="You are a college professor with phd in linguistics and physics."
-            #record={"page":page,"score":score,"text":answer}
-            final_list.append(f"{page}-{score}-{ID}-{answer}")
-            #final_list.append(record)#List of results
+
+            #Keep only the chunks the LLM judges relevant (checked in parallel)
+            if relevance_gate and results:
+                retrieved = len(results)
+                with span('relevance_filter', chunks=retrieved):
+                    results = filter_relevant(expert, query, results)
+                st.caption(f"{len(results)} of {retrieved} retrieved chunks judged relevant")
+                if not results:
+                    st.write("None of the retrieved passages support answering this question.")
+                    return
+        
+            #Merge overlapping chunks and fit the passages into the token budget
+            with span('context_pack', chunks=len(results)):
+                results, pack_stats = pack_context(results, token_budget)
+
+            #Display results
+            #Loop thru each result
+            for result in results:
+                ID=result["id"]            #Document ID
+                answer=result['text'] #Text from record
+                score=result['score']                #Confidence score for match
+                page=result["page_number"] #Match page number
+                text_dict[ID]=answer                #Stores original text in dictionary
+                #record={"page":page,"score":score,"text":answer}
+                final_list.append(f"{page}-{score}-{ID}-{answer}")
+                #final_list.append(record)#List of results
                     
-        #LLM Conclusion Task given query and list of answers--
-        task=conlcusion(query,  final_list)#LLM task for determining conclusion
-        out=query_gemini(task)#Query LLM
-        if out!="":
-            out=parse_llm(out)#Parse LLM results
-            out2=out.replace('\\', '\\\\')
-            display_results(out2,text_dict)
+            #LLM Conclusion Task given query and list of answers--
+            count('chunks_sent_to_llm', len(final_list))
+            with span('prompt_build'):
+                task=conlcusion(query,  final_list)#LLM task for determining conclusion
+            prompt_tokens = estimate_tokens(task)
+            count('prompt_tokens', prompt_tokens)
+            st.caption(f"Prompt ~{prompt_tokens} tokens: {pack_stats['chunks']} chunks packed into {pack_stats['passages']} passages "
+                       f"({pack_stats['merged']} merged, {pack_stats['duplicates']} duplicates, "
+                       f"{pack_stats['truncated']} truncated, {pack_stats['dropped']} dropped)")
+            if stream_answer_mode:
+                st.write("**AI Summary**")
+                pieces = []
+                complete = False
+                try:
+                    with span('llm_stream', prompt_chars=len(task), prompt_tokens=prompt_tokens):
+                        st.write_stream(stream_answer(task, pieces))  # Summary appears as it is generated
+                    complete = True
+                except Exception as e:
+                    st.write(f"Unable to query llm. Please check network connection:  {e}")
+                if pieces:
+                    out = parse_llm("".join(pieces))
+                    display_results(out, text_dict, show_summary=False)
+                    if complete and scope is not None:  # Partial answers are shown but not cached
+                        answer_cache.put(scope, query_embedding, query, {'out': out, 'text_dict': text_dict})
+                return
+            out, query_state=query_gemini(task)#Query LLM
+            if out!="":
+                out=parse_llm(out)#Parse LLM results
+                out2=out.replace('\\', '\\\\')
+                display_results(out2,text_dict)
+                if scope is not None:
+                    answer_cache.put(scope, query_embedding, query, {'out': out2, 'text_dict': text_dict})
 
 
 if __name__ == "__main__":
-    main()
+    # Streamlit re-executes this script on every rerun. Running main() from the imported module
+    # keeps the model and index caches alive across reruns and sessions.
+    import doc_anatomy_demo
+    doc_anatomy_demo.main()
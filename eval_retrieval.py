@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import doc_anatomy_demo as dad
+from benchmark import HashingEmbedder, index_bytes, percentiles
+
+#Offline retrieval evaluation: sweeps chunk_size x overlap x index type x retrieval mode x top_k over the bundled PDFs.
+#   python eval_retrieval.py --json eval_results.json
+#   python eval_retrieval.py --chunk-sizes 256 512 --overlaps 0 50 --index-types flat hnsw --top-k 3 5
+#Each line of the questions file is {"file": base name, "query": str, "pages": [expected page labels]}.
+#A retrieved chunk counts as relevant when its page is one of the expected pages. Every configuration
+#reports Precision@K, MRR, index build time, index size and query latency, and the configurations
+#not beaten on all of precision, MRR, latency and size are marked Pareto-optimal for that document.
+
+def load_questions(path):
+    questions = {}
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                questions.setdefault(record['file'], []).append((record['query'], {str(p) for p in record['pages']}))
+    return questions
+
+def score_hits(hits, pages, top_k):
+    #Precision@K and reciprocal rank of the first relevant chunk
+    relevant = [str(hit['page_number']) in pages for hit in hits]
+    precision = sum(relevant) / top_k
+    rank = relevant.index(True) + 1 if True in relevant else 0
+    return precision, 1 / rank if rank else 0.0
+
+def evaluate(embedding_model, file_base, questions, top_k, mode, repeats):
+    #Quality and latency of one built index (caches cleared before every query)
+    precisions, reciprocal_ranks, samples = [], [], []
+    for _ in range(repeats):
+        for query, pages in questions:
+            dad.query_embedding_cache.purge()
+            dad.result_cache.purge()
+            start = time.perf_counter()
+            hits = dad.query_faiss_index(embedding_model, file_base, query, top_k, mode=mode)
+            samples.append(time.perf_counter() - start)
+            if len(precisions) < len(questions):
+                precision, rr = score_hits(hits, pages, top_k)
+                precisions.append(precision)
+                reciprocal_ranks.append(rr)
+    return {'precision': float(np.mean(precisions)), 'mrr': float(np.mean(reciprocal_ranks)), **percentiles(samples)}
+
+def sweep_file(embedding_model, path, questions, chunk_sizes, overlaps, index_types, modes, top_ks, repeats):
+    file_base = os.path.splitext(os.path.basename(path))[0]
+    documents = dad.llama_simple_reader(path)
+    rows = []
+    for chunk_size in chunk_sizes:
+        for overlap in overlaps:
+            if overlap >= chunk_size:
+                continue
+            _, record_dict = dad.chunk_documents(file_base, documents, path, chunk_size, overlap)
+            start = time.perf_counter()
+            embeddings, ids = dad.embed_record_dict(record_dict, embedding_model)
+            embed_seconds = time.perf_counter() - start
+            for index_type in index_types:
+                start = time.perf_counter()
+                index, _ = dad.index_embeddings(embeddings, ids, record_dict, file_base, index_type)
+                build_seconds = time.perf_counter() - start
+                size = index_bytes(file_base)
+                for mode in modes:
+                    for top_k in top_ks:
+                        row = {'file': file_base, 'chunk_size': chunk_size, 'chunk_overlap': overlap,
+                               'index_type': index_type, 'built': dad.describe_index(index), 'mode': mode, 'top_k': top_k,
+                               'chunks': len(ids), 'embed_s': embed_seconds, 'build_s': build_seconds, 'index_bytes': size}
+                        row.update(evaluate(embedding_model, file_base, questions, top_k, mode, repeats))
+                        rows.append(row)
+                        print(f"{file_base:<16}{chunk_size:>6}{overlap:>6}  {index_type:<9}{mode:<7}{top_k:>4}{row['precision']:>8.3f}"
+                              f"{row['mrr']:>8.3f}{row['build_s']:>9.3f}{size / 1024:>9.0f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}")
+    return rows
+
+def mark_pareto(rows):
+    #A row is Pareto-optimal when no other row of the same file is at least as good on every axis and better on one
+    def dominates(a, b):
+        better_or_equal = (a['precision'] >= b['precision'] and a['mrr'] >= b['mrr']
+                           and a['p50_ms'] <= b['p50_ms'] and a['index_bytes'] <= b['index_bytes'])
+        strictly_better = (a['precision'] > b['precision'] or a['mrr'] > b['mrr']
+                           or a['p50_ms'] < b['p50_ms'] or a['index_bytes'] < b['index_bytes'])
+        return better_or_equal and strictly_better
+    for row in rows:
+        row['pareto'] = not any(dominates(other, row) for other in rows if other['file'] == row['file'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Precision@K / MRR / latency sweep over chunking and index settings")
+    parser.add_argument("--questions", default="eval_questions.jsonl")
+    parser.add_argument("--pdf-folder", default=dad.PDF)
+    parser.add_argument("--chunk-sizes", type=int, nargs="*", default=[256, 512, 1024])
+    parser.add_argument("--overlaps", type=int, nargs="*", default=[0, 50, 100])
+    parser.add_argument("--index-types", nargs="*", default=dad.index_types, choices=dad.index_types)
+    parser.add_argument("--modes", nargs="*", default=dad.retrieval_modes, choices=dad.retrieval_modes)
+    parser.add_argument("--top-k", type=int, nargs="*", default=[1, 3, 5, 10])
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the questions per latency measurement")
+    parser.add_argument("--hash-embeddings", action="store_true", help="Use the hashing embedder instead of the model")
+    parser.add_argument("--json", help="Write the rows to this file")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    embedding_model = HashingEmbedder() if args.hash_embeddings else dad.get_embedding_model()
+    pdf_folder = os.path.abspath(args.pdf_folder)
+    rows = []
+    cwd = os.getcwd()
+    print(f"{'file':<16}{'chunk':>6}{'ovlp':>6}  {'index':<9}{'mode':<7}{'k':>4}{'P@K':>8}{'MRR':>8}{'build s':>9}"
+          f"{'size KB':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "indexed_pdfs"))
+        os.chdir(workdir)  # Index files are written under the current directory, keep indexed_pdfs/ untouched
+        try:
+            for file_base, file_questions in questions.items():
+                path = os.path.join(pdf_folder, f"{file_base}.pdf")
+                if not os.path.exists(path):
+                    print(f"No PDF for {file_base}, skipped")
+                    continue
+                rows.extend(sweep_file(embedding_model, path, file_questions, args.chunk_sizes, args.overlaps,
+                                       args.index_types, args.modes, args.top_k, args.repeats))
+        finally:
+            os.chdir(cwd)
+            dad.invalidate_index()
+
+    mark_pareto(rows)
+    print("\nPareto-optimal configurations:")
+    for row in rows:
+        if row['pareto']:
+            print(f"  {row['file']:<16}chunk {row['chunk_size']:<5}overlap {row['chunk_overlap']:<4}{row['index_type']:<9}{row['mode']:<7}"
+                  f"k={row['top_k']:<3}P@K {row['precision']:.3f}  MRR {row['mrr']:.3f}  "
+                  f"p50 {row['p50_ms']:.2f}ms  {row['index_bytes'] / 1024:.0f} KB")
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(rows, indent=2))
+
+if __name__ == "__main__":
+    main()
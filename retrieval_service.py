@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from doc_anatomy_demo import (get_embedding_model, query_batch, query_corpus_batch, reindex_file, indexed_files,
+                              source_files, cache_stats, warm_up_model)
+from tracing import trace_request, metrics_text
+
+#Headless retrieval service: one warm process holding the embedding model and indexes.
+#   python retrieval_service.py --port 8600
+#Endpoints (JSON over HTTP/1.1 keep-alive):
+#   POST /search   {"query": str, "top_k": int, "file": str | null, "files": [str], "mode": "dense" | "hybrid"}
+#                  -> {"results": [...]}  (file null searches every document, optionally limited to files)
+#   POST /reindex  {"file": str, "chunk_size": int, "chunk_overlap": int, "index_type": str, "force": bool}
+#                  -> {"reindexed": bool}
+#   GET  /files    -> {"files": [...]}
+#   GET  /health   -> {"status": "ok", "stats": {...}}
+#   GET  /metrics  -> counters and stage timings in Prometheus text format
+#Concurrent /search requests arriving within a short window are answered with one encode pass
+#and one FAISS search per (file, top_k, mode) group.
+
+batch_window=float(os.environ.get("RETRIEVAL_BATCH_WINDOW_MS","5"))/1000#Seconds to wait for more queries
+batch_max=int(os.environ.get("RETRIEVAL_BATCH_MAX","64"))#Queries per micro-batch
+max_top_k=int(os.environ.get("RETRIEVAL_MAX_TOP_K","1000"))#Largest top_k a client may request
+
+def unknown_files(names, known):
+    #Requested file names missing from known (indexed files for /search, source files for /reindex).
+    #Names are joined into index and source paths, so anything else (e.g. "../secret") is rejected before it reaches them.
+    known = set(known)
+    return [name for name in names if not isinstance(name, str) or name not in known]
+
+class MicroBatcher:
+    #Collects concurrent search requests and answers them in batches from a single worker thread
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.queries = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def search(self, query, top_k, file=None, files=(), mode=None):
+        #Queue one query and block until its batch has been searched
+        future = Future()
+        self.requests.put(((file, tuple(files), top_k, mode), query, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.answer(batch)
+
+    def answer(self, batch):
+        groups = {}
+        for key, query, future in batch:
+            groups.setdefault(key, []).append((query, future))
+        embedding_model = get_embedding_model()
+        for (file, files, top_k, mode), items in groups.items():
+            queries = [query for query, _ in items]
+            try:
+                with trace_request("search_batch", file=file or "*", top_k=top_k, queries=len(queries)):
+                    if file:
+                        results = query_batch(embedding_model, file, queries, top_k, mode=mode)
+                    else:
+                        results = query_corpus_batch(embedding_model, queries, top_k, list(files))
+                results = results or [[] for _ in queries]
+                for (_, future), hits in zip(items, results):
+                    future.set_result(hits)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+        self.batches += 1
+        self.queries += len(batch)
+
+batcher = None
+reindex_lock = threading.Lock()
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections open between requests
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, default=str, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "stats": {"cache": cache_stats(),
+                                                           "batches": batcher.batches, "queries": batcher.queries}})
+        elif self.path == "/files":
+            self.send_json(200, {"files": indexed_files()})
+        elif self.path == "/metrics":
+            data = metrics_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+        if not isinstance(body, dict):
+            self.send_json(400, {"error": "Request body must be a JSON object"})
+            return
+        try:
+            if self.path == "/search":
+                if not body.get("query"):
+                    self.send_json(400, {"error": "query is required"})
+                    return
+                files = body.get("files") or []
+                if not isinstance(files, list):
+                    self.send_json(400, {"error": "files must be a list"})
+                    return
+                unknown = unknown_files(files + ([body["file"]] if body.get("file") is not None else []), indexed_files())
+                if unknown:
+                    self.send_json(400, {"error": f"Unknown files {unknown}"})
+                    return
+                top_k = int(body.get("top_k", 5))
+                if not 1 <= top_k <= max_top_k:
+                    self.send_json(400, {"error": f"top_k must be between 1 and {max_top_k}"})
+                    return
+                results = batcher.search(body["query"], top_k, body.get("file"), files, body.get("mode"))
+                self.send_json(200, {"results": results})
+            elif self.path == "/reindex":
+                if unknown_files([body["file"]], source_files()):
+                    self.send_json(400, {"error": f"No source file for {body['file']!r}"})
+                    return
+                with reindex_lock:
+                    reindexed = reindex_file(body["file"], int(body.get("chunk_size", 512)), int(body.get("chunk_overlap", 50)),
+                                             get_embedding_model(), bool(body.get("force", False)), body.get("index_type"))
+                self.send_json(200, {"reindexed": reindexed})
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+        except KeyError as e:
+            self.send_json(400, {"error": f"Missing field {e}"})
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            print(f"Error handling {self.path}: {e}")
+            self.send_json(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    global batcher
+    parser = argparse.ArgumentParser(description="Retrieval service for indexed PDFs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    args = parser.parse_args()
+
+    warm_up_model()
+    batcher = MicroBatcher(batch_window, batch_max)
+    server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+    print(f"Retrieval service listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
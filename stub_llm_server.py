@@ -0,0 +1,72 @@
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Local stand-in for the Gemini generateContent API, for exercising the LLM stages offline.
+#   python stub_llm_server.py --port 8765 --delay 0.5
+#   GEMINI_BASE_URL=http://localhost:8765 GEMINI_API_KEY=stub streamlit run doc_anatomy_demo.py
+#Relevance prompts (build_prompt) are answered YES when the TEXT shares enough words with the
+#question; any other prompt gets a fixed summary in the ANSWER/JUSTIFICATION format.
+#streamGenerateContent requests receive the same reply as server-sent events, a few words at a time.
+
+def words(text):
+    return {w for w in re.findall(r"[a-z]{4,}", text.lower())}
+
+def reply(prompt):
+    #Stub answer for a prompt
+    if "Answer YES or NO" in prompt:
+        question = prompt.split("Question:", 1)[-1].split("Does the TEXT", 1)[0]
+        text = prompt.split("TEXT\n", 1)[-1]
+        verdict = "YES" if len(words(question) & words(text)) >= 1 else "NO"
+        return f'```{{"ANSWER":["{verdict}"]}}```'
+    return '```{"ANSWER":"Stub summary of the retrieved passages.","JUSTIFICATION":[]}```'
+
+def candidate(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+        text = reply(prompt)
+        if ":streamGenerateContent" in self.path:
+            self.stream(text)
+            return
+        time.sleep(self.delay)
+        data = json.dumps(candidate(text)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, text):
+        #Send text as server-sent events, spreading the delay over the pieces
+        pieces = re.findall(r"\S+\s*", text) or [text]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for piece in pieces:
+            time.sleep(self.delay / len(pieces))
+            self.wfile.write(f"data: {json.dumps(candidate(piece))}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Gemini server for local testing")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before each response")
+    args = parser.parse_args()
+    StubHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubHandler)
+    print(f"Stub LLM listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
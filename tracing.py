@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+#Per-request tracing: timing spans for each pipeline stage plus process-wide counters.
+#A trace is started with trace_request() and spans/counters recorded inside it (on the same
+#thread) are attached to it. Finished traces are kept in memory for the debug panel and, when
+#TRACE_FILE is set, appended to it as JSONL. METRICS_FILE receives the counters and stage
+#timings in Prometheus text format after every trace.
+
+trace_file=os.environ.get("TRACE_FILE","")#JSONL sink for finished traces
+metrics_file=os.environ.get("METRICS_FILE","")#Prometheus text sink
+trace_history=int(os.environ.get("TRACE_HISTORY","20"))#Finished traces kept for the debug panel
+
+recent_traces=deque(maxlen=trace_history)
+counters={}#name -> running total
+stage_totals={}#stage -> [count, total seconds]
+metrics_lock=threading.Lock()
+current=threading.local()
+
+def active_trace():
+    return getattr(current, 'trace', None)
+
+@contextmanager
+def trace_request(name, **attrs):
+    #Start a trace for one request; spans and counters recorded on this thread are attached to it
+    trace = {'name': name, 'start': time.time(), 'attrs': attrs, 'spans': [], 'counters': {}, 'errors': []}
+    previous = active_trace()
+    current.trace = trace
+    begin = time.perf_counter()
+    try:
+        yield trace
+    except Exception as e:
+        trace['errors'].append({'stage': name, 'error': repr(e)})
+        raise
+    finally:
+        trace['total_ms'] = (time.perf_counter() - begin) * 1000
+        current.trace = previous
+        finish(trace)
+
+@contextmanager
+def span(name, **attrs):
+    #Time one stage. Exceptions are recorded on the trace and re-raised.
+    begin = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - begin
+        with metrics_lock:
+            totals = stage_totals.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+        trace = active_trace()
+        if trace is not None:
+            record = {'name': name, 'ms': elapsed * 1000, **attrs}
+            if error:
+                record['error'] = error
+                trace['errors'].append({'stage': name, 'error': error})
+            trace['spans'].append(record)
+
+def count(name, value=1):
+    #Add to a process-wide counter and to the active trace
+    with metrics_lock:
+        counters[name] = counters.get(name, 0) + value
+    trace = active_trace()
+    if trace is not None:
+        trace['counters'][name] = trace['counters'].get(name, 0) + value
+
+def record_error(stage, error):
+    #Attach an error that was handled (not raised) to the active trace
+    count('errors_total')
+    trace = active_trace()
+    if trace is not None:
+        trace['errors'].append({'stage': stage, 'error': repr(error)})
+
+def finish(trace):
+    recent_traces.append(trace)
+    if trace_file:
+        try:
+            with metrics_lock, open(trace_file, "a") as f:
+                f.write(json.dumps(trace, default=str) + "\n")
+        except OSError as e:
+            print(f"Unable to write trace: {e}")
+    if metrics_file:
+        write_metrics(metrics_file)
+
+def metrics_text():
+    #Counters and per-stage timing summaries in Prometheus text exposition format
+    lines = []
+    with metrics_lock:
+        for name, value in sorted(counters.items()):
+            metric = f"docanatomy_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        if stage_totals:
+            lines.append("# TYPE docanatomy_stage_seconds summary")
+            for stage, (n, total) in sorted(stage_totals.items()):
+                lines.append(f'docanatomy_stage_seconds_count{{stage="{stage}"}} {n}')
+                lines.append(f'docanatomy_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+    return "\n".join(lines) + "\n"
+
+def write_metrics(path):
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write(metrics_text())
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Unable to write metrics: {e}")
+
+def trace_rows():
+    #One row per recent trace (newest first) with the milliseconds spent in each stage
+    rows = []
+    for trace in reversed(recent_traces):
+        row = {'request': trace['name'], 'total_ms': round(trace['total_ms'], 1)}
+        for record in trace['spans']:
+            row[record['name']] = round(row.get(record['name'], 0) + record['ms'], 1)
+        row.update(trace['counters'])
+        row['errors'] = len(trace['errors'])
+        rows.append(row)
+    return rows